@@ -2,10 +2,12 @@ import connexion
 from connexion import NoContent
 import json
 import yaml
+import validation
 import logging
 import logging.config
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
+from event_codec import decode_event, event_type
 from threading import Thread
 from dotenv import load_dotenv
 from flask_cors import CORS
@@ -45,12 +47,9 @@ def get_running_stats(index):
     count = 0
     try:
         for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            
-            if msg["type"] == "running_stats":
+            if event_type(msg.value) == "running_stats":
                 if count == index:
-                    return msg["payload"], 200
+                    return decode_event(msg.value)["payload"], 200
                 count += 1
                 
     except:
@@ -72,12 +71,9 @@ def get_music_info(index):
     count = 0
     try:
         for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
-            
-            if msg["type"] == "music_info":
+            if event_type(msg.value) == "music_info":
                 if count == index:
-                    return msg["payload"], 200
+                    return decode_event(msg.value)["payload"], 200
                 count += 1
                 
     except:
@@ -103,12 +99,11 @@ def get_stats():
     
     try:
         for msg in consumer:
-            msg_str = msg.value.decode('utf-8')
-            msg = json.loads(msg_str)
+            msg_type = event_type(msg.value)
             
-            if msg["type"] == "running_stats":
+            if msg_type == "running_stats":
                 stats["num_running_stats"] += 1
-            elif msg["type"] == "music_info":
+            elif msg_type == "music_info":
                 stats["num_music_info"] += 1
                 
     except:
@@ -118,7 +113,7 @@ def get_stats():
     return stats, 200
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/analyzer",strict_validation=True, validate_responses=True)
+app.add_api("openapi.yaml", base_path="/analyzer", **validation.api_options(app_config))
 CORS(app.app)
 
 if __name__ == "__main__":
@@ -0,0 +1,98 @@
+"""Request and response validation settings for add_api()
+
+connexion builds a new jsonschema validator for every request body and
+every response it checks. The validators below compile each schema once
+and reuse it, and response validation can be sampled (or switched off) in
+production through the `validation` section of app_conf.yml:
+
+    validation:
+      strict: true
+      response_sample_rate: 0.01
+
+A copy of this module lives in every service; keep them identical.
+"""
+import random
+
+from connexion.datastructures import MediaTypeDict
+from connexion.json_schema import Draft4RequestValidator, Draft4ResponseValidator
+from connexion.validators import (
+    VALIDATOR_MAP,
+    JSONRequestBodyValidator,
+    JSONResponseBodyValidator,
+    TextResponseBodyValidator,
+)
+
+# (validator class, id(schema)) -> (schema, compiled validator). connexion
+# hands out the same schema dict for an operation on every request, the
+# schema is kept in the value so its id cannot be reused while cached.
+_compiled = {}
+
+
+def compiled_validator(validator_cls, schema):
+    """Return a validator for schema, compiling it on first use only"""
+    key = (validator_cls, id(schema))
+    entry = _compiled.get(key)
+    if entry is None or entry[0] is not schema:
+        entry = (schema, validator_cls(schema, format_checker=validator_cls.FORMAT_CHECKER))
+        _compiled[key] = entry
+    return entry[1]
+
+
+class CompiledJSONRequestBodyValidator(JSONRequestBodyValidator):
+    """JSON request body validator that reuses the compiled schema"""
+
+    @property
+    def _validator(self):
+        return compiled_validator(Draft4RequestValidator, self._schema)
+
+
+class SampledJSONResponseBodyValidator(JSONResponseBodyValidator):
+    """JSON response body validator that checks a fraction of responses"""
+
+    sample_rate = 1.0
+
+    @property
+    def validator(self):
+        return compiled_validator(Draft4ResponseValidator, self._schema)
+
+    def wrap_send(self, send):
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return send
+        return super().wrap_send(send)
+
+
+class StreamingResponseBodyValidator(JSONResponseBodyValidator):
+    """Leaves streamed newline-delimited JSON alone
+
+    "*/*json" also matches application/x-ndjson, and the JSON validator
+    would buffer the whole stream and fail to parse it as one document.
+    """
+
+    def wrap_send(self, send):
+        return send
+
+
+def api_options(app_config):
+    """Keyword arguments for add_api() built from the validation settings"""
+    settings = app_config.get('validation', {})
+    sample_rate = float(settings.get('response_sample_rate', 1.0))
+
+    response_validator = type("SampledJSONResponseBodyValidator",
+                              (SampledJSONResponseBodyValidator,),
+                              {"sample_rate": sample_rate})
+
+    return {
+        "strict_validation": settings.get('strict', True),
+        "validate_responses": sample_rate > 0,
+        "validator_map": {
+            "body": MediaTypeDict({
+                **VALIDATOR_MAP["body"],
+                "*/*json": CompiledJSONRequestBodyValidator,
+            }),
+            "response": MediaTypeDict({
+                "*/*json": response_validator,
+                "application/x-ndjson": StreamingResponseBodyValidator,
+                "text/plain": TextResponseBodyValidator,
+            }),
+        },
+    }
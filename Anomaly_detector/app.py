@@ -2,12 +2,17 @@ import connexion
 from connexion import NoContent
 import json
 import yaml
+import validation
 import logging
 import logging.config
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
+from event_codec import decode_event
+from dead_letter import publish_dead_letter
 from threading import Thread
 import os
+import fcntl
+import contextlib
 from datetime import datetime
 import time
 from flask_cors import CORS
@@ -32,6 +37,21 @@ logger = logging.getLogger('basicLogger')
 logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
+@contextlib.contextmanager
+def datastore_lock(exclusive):
+    """Hold a lock on the datastore file shared by every replica and thread
+
+    Replicas of the Anomaly Detector run on one host against the same
+    volume, so an flock on a file next to the datastore keeps their
+    read-modify-write updates from overwriting each other.
+    """
+    with open(app_config["datastore"]["filename"] + ".lock", 'a') as handle:
+        fcntl.flock(handle, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(handle, fcntl.LOCK_UN)
+
 def get_anomalies(anomaly_type=None):
     """Get anomalies from the datastore"""
     logger.info(f"Request for anomalies with type {anomaly_type}")
@@ -40,8 +60,9 @@ def get_anomalies(anomaly_type=None):
         logger.error("Datastore file not found")
         return {"message": "Statistics do not exist"}, 404
 
-    with open(app_config["datastore"]["filename"], 'r') as f:
-        anomalies = json.load(f)
+    with datastore_lock(exclusive=False):
+        with open(app_config["datastore"]["filename"], 'r') as f:
+            anomalies = json.load(f)
 
     if anomaly_type:
         anomalies = [a for a in anomalies if a["anomaly_type"] == anomaly_type]
@@ -54,26 +75,29 @@ def get_anomalies(anomaly_type=None):
 def add_anomaly(anomaly):
     """Add a new anomaly to the datastore"""
     
-    if not os.path.exists(app_config["datastore"]["filename"]):
+    with datastore_lock(exclusive=True):
+        if not os.path.exists(app_config["datastore"]["filename"]):
+            with open(app_config["datastore"]["filename"], 'w') as f:
+                json.dump([], f)
+        
+        with open(app_config["datastore"]["filename"], 'r') as f:
+            anomalies = json.load(f)
+        
+        anomalies.append(anomaly)
+        
         with open(app_config["datastore"]["filename"], 'w') as f:
-            json.dump([], f)
-    
-    with open(app_config["datastore"]["filename"], 'r') as f:
-        anomalies = json.load(f)
-    
-    anomalies.append(anomaly)
-    
-    with open(app_config["datastore"]["filename"], 'w') as f:
-        json.dump(anomalies, f, indent=2)
+            json.dump(anomalies, f, indent=2)
     
     logger.info(f"Added new anomaly: {anomaly}")
 
-def process_messages():
+def process_messages(topic_name, consumer_group):
+    """Check every event of topic_name against the thresholds"""
     message_batch_size = 1000  
     batch_timeout = 300        
     retry_count = 0
     max_retries = 3
     consumer = None
+    dead_letters = None
     
     hostname = "%s:%d" % (app_config['events']['hostname'], app_config['events']['port'])
     logger.info("Starting message processing service")
@@ -87,16 +111,19 @@ def process_messages():
             if consumer is None:
                 logger.info("Attempting to establish Kafka connection")
                 client = KafkaClient(hosts=hostname)
-                topic = client.topics[str.encode(app_config["events"]["topic"])]
-                consumer = topic.get_simple_consumer(
-                    consumer_group=b'anomaly_detector_group',
+                topic = client.topics[str.encode(topic_name)]
+                consumer = topic.get_balanced_consumer(
+                    consumer_group=consumer_group,
+                    managed=True,
+                    auto_commit_enable=False,
                     reset_offset_on_start=False,
                     auto_offset_reset=OffsetType.LATEST
                 )
+                dead_letters = client.topics[str.encode(app_config["events"]["dead_letter_topic"])].get_sync_producer()
                 logger.info("Successfully connected to Kafka")
                 retry_count = 0 
             
-            for msg in consumer:
+            for message in consumer:
                 try:
                     message_count += 1
                     current_time = time.time()
@@ -106,8 +133,7 @@ def process_messages():
                         message_count = 0
                         start_time = current_time
                     
-                    msg_str = msg.value.decode('utf-8')
-                    msg = json.loads(msg_str)
+                    msg = decode_event(message.value)
                     logger.debug(f"Received event: {msg}")  
                     
                     payload = msg["payload"]
@@ -163,18 +189,19 @@ def process_messages():
                             add_anomaly(anomaly)
                             logger.info(f"Detected ShortSong anomaly: {payload['user_id']}")
                     
-                    consumer.commit_offsets()
-                    
-                except json.JSONDecodeError as e:
-                    logger.error(f"Error decoding message: {e}")
-                    continue  
+                except ValueError as e:
+                    logger.error(f"Error decoding message at offset {message.offset}: {e}")
+                    publish_dead_letter(dead_letters, message, e, "anomaly_detector")
                 except Exception as e:
-                    logger.error(f"Error processing individual message: {e}")
-                    continue 
+                    logger.error(f"Error processing message at offset {message.offset}: {e}")
+                    publish_dead_letter(dead_letters, message, e, "anomaly_detector")
+
+                consumer.commit_offsets()
             
         except Exception as e:
             logger.error(f"Error in message processing loop: {str(e)}")
-            consumer = None  
+            consumer = None
+            dead_letters = None
             retry_count += 1
             
             if retry_count >= max_retries:
@@ -187,13 +214,17 @@ def process_messages():
                 time.sleep(sleep_time)
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/anomaly", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yaml", base_path="/anomaly", **validation.api_options(app_config))
 CORS(app.app)
 
 if __name__ == "__main__":
-    t1 = Thread(target=process_messages)
-    t1.setDaemon(True)
+    t1 = Thread(target=process_messages, args=(app_config["events"]["topic"], b'anomaly_detector_group'))
+    t1.daemon = True
     t1.start()
+    # dead letters of this service re-driven by replay_dead_letters.py
+    t2 = Thread(target=process_messages, args=(app_config["events"]["replay_topic"], b'anomaly_detector_replay_group'))
+    t2.daemon = True
+    t2.start()
     
     logger.info("Starting Anomaly Detector Service")
     logger.info(f"Running thresholds: max_distance={app_config['thresholds']['running']['max_distance']}m, min_duration={app_config['thresholds']['running']['min_duration']}s")
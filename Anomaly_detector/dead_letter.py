@@ -0,0 +1,45 @@
+"""Records written to the dead-letter topic
+
+A message that cannot be decoded or processed is wrapped, with the error
+and where it came from, and published to events.dead_letter_topic keyed
+like the original, so the consumer can commit past it instead of
+stalling its partition. Once the cause is fixed, replay_dead_letters.py
+in Storage publishes the original bytes to the replay topic of the
+service that rejected them (events.replay_topics[source]), which that
+service consumes on a separate thread; they are not sent back to the
+events topic.
+
+A copy of this module lives in every service that dead-letters
+messages; keep them identical.
+"""
+import base64
+import json
+from datetime import datetime
+
+
+def dead_letter(message, error, source):
+    """Serialize a failed pykafka message and its error to bytes"""
+    key = message.partition_key
+    return json.dumps({
+        "source": source,
+        "error": str(error),
+        "partition": message.partition_id,
+        "offset": message.offset,
+        "failed_at": datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "partition_key": base64.b64encode(key).decode("ascii") if key else None,
+        "value": base64.b64encode(message.value or b"").decode("ascii"),
+    }).encode("utf-8")
+
+
+def publish_dead_letter(producer, message, error, source):
+    """Publish one failed message to the dead-letter topic"""
+    producer.produce(dead_letter(message, error, source), partition_key=message.partition_key)
+
+
+def parse_dead_letter(data):
+    """Deserialize a dead-letter record, decoding the original key and value back to bytes"""
+    record = json.loads(data.decode("utf-8"))
+    record["value"] = base64.b64decode(record["value"])
+    if record["partition_key"] is not None:
+        record["partition_key"] = base64.b64decode(record["partition_key"])
+    return record
@@ -1,14 +1,24 @@
 import connexion
-from connexion import NoContent
+from connexion import NoContent, request
 import yaml
+import validation
 import logging
 import logging.config
 from apscheduler.schedulers.background import BackgroundScheduler
 import requests
 import json
+import copy
+import hashlib
 from datetime import datetime
 import os
+import time
 import traceback
+from threading import Lock, Thread
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from event_codec import decode_event
+from timeseries import RingSeries, parse_timestamp
+from sketches import DDSketch, HyperLogLog, SpaceSaving
 from flask_cors import CORS
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
@@ -33,31 +43,90 @@ logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 
 
+# Fields of the stats checkpoint that are not part of the /stats response
+INTERNAL_FIELDS = ('offsets', 'last_window', 'timeseries', 'sketches', 'top')
+
+# Working stats, owned by whichever of stream_stats() / populate_stats() runs
+state = None
+
+# (stats, ETag) served by get_stats(). Replaced as a whole on every
+# checkpoint, so readers never see a half-updated dict and never touch disk.
+published = None
+
+# resolution -> RingSeries, sized by the timeseries section of app_conf.yml
+series = {}
+series_lock = Lock()
+
+# Quantile sketches of the values, and a HyperLogLog of the user_ids, of
+# every event processed
+QUANTILES = {'p50': 0.5, 'p95': 0.95, 'p99': 0.99}
+SKETCHED_VALUES = {
+    'run_duration': ('running_stats', 'duration'),
+    'run_distance': ('running_stats', 'distance'),
+    'song_duration': ('music_info', 'song_duration'),
+}
+quantile_sketches = {}
+distinct_users = HyperLogLog()
+
+# Space-saving counters of the heaviest keys: name -> (event type, key, weight)
+HEAVY_HITTERS = {
+    'users_by_distance': ('running_stats', lambda payload: payload['user_id'], lambda payload: payload['distance']),
+    'artists_by_plays': ('music_info', lambda payload: payload['artist'], lambda payload: 1),
+    'songs_by_plays': ('music_info', lambda payload: f"{payload['artist']} - {payload['song_name']}", lambda payload: 1),
+}
+heavy_hitters = {}
+sketch_lock = Lock()
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    return '*' in tags or etag in tags or f"W/{etag}" in tags
+
 def get_stats():
     logger.info("Request for statistics has started")
     
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_dir, app_config['datastore']['filename'])
-    
-    if not os.path.exists(file_path): 
-        logger.error(f"Statistics do not exist at {file_path}")
+    if published is None:
+        logger.error("Statistics have not been loaded")
         return {"message": "Statistics do not exist"}, 404
     
-    with open(file_path, 'r') as f: 
-        stats = json.load(f)
+    stats, etag = published
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        logger.info("Statistics not modified")
+        return NoContent, 304, {'ETag': etag}
     
     logger.info(f"Statistics retrieved: {stats}")
     logger.info("Request for statistics has completed")
     
-    return stats, 200
+    return stats, 200, {'ETag': etag}
 
-def populate_stats():
-    """ Periodically update stats """
-    logger.info("Start Periodic Processing")
-    # logger.info("DEMO ASSIGNMENT 3 - AFTER REPO")
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_dir, app_config['datastore']['filename'])
+def get_timeseries(resolution='1m', **window):
+    """ Per-bucket counts, totals and maxima of the runs and songs in [from, to] """
+    logger.info(f"Request for the {resolution} timeseries has started")
+    try:
+        start = parse_timestamp(window['from']) if window.get('from') else None
+        end = parse_timestamp(window['to']) if window.get('to') else None
+    except ValueError:
+        return {"message": "from and to must look like 2024-01-31T12:00:00Z"}, 400
     
+    if resolution not in series:
+        return {"message": f"Unknown resolution {resolution}"}, 400
+    
+    with series_lock:
+        buckets = series[resolution].query(start, end)
+    
+    logger.info(f"Returning {len(buckets)} {resolution} buckets")
+    return {"resolution": resolution,
+            "bucket_sec": series[resolution].bucket_sec,
+            "buckets": buckets}, 200
+
+def stats_file_path():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(current_dir, app_config['datastore']['filename'])
+
+def load_stats():
+    """ Read the stats file, creating it with empty stats the first time """
+    file_path = stats_file_path()
     logger.info(f"Checking for stats file at: {file_path}")
     
     if not os.path.exists(file_path):
@@ -70,8 +139,7 @@ def populate_stats():
             "avg_song_duration": 0,
             "last_updated": "2000-01-01T00:00:00Z"
         }
-        with open(file_path, 'w') as f:
-            json.dump(stats, f, indent=4)
+        save_stats(stats)
         logger.info("Created new stats file")
     else:
         with open(file_path, 'r') as f:
@@ -79,37 +147,161 @@ def populate_stats():
 
         stats.setdefault('avg_run_duration', 0)
         stats.setdefault('avg_song_duration', 0)
+    return stats
+
+def save_stats(stats):
+    """ Write the checkpoint to a temp file and rename it over the old one
+
+    The rename is atomic, so a crash leaves either the previous or the new
+    checkpoint on disk, never a half-written one.
+    """
+    file_path = stats_file_path()
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        # compact: the checkpoint holds the timeseries and sketches too
+        json.dump(stats, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+    dir_fd = os.open(os.path.dirname(file_path), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+def publish_stats(stats):
+    """ Make a snapshot of stats the one served by get_stats() """
+    global published
+    public = copy.deepcopy({key: value for key, value in stats.items() if key not in INTERNAL_FIELDS})
+    etag = '"%s"' % hashlib.sha1(json.dumps(public, sort_keys=True).encode()).hexdigest()[:20]
+    published = (public, etag)
+
+def get_top(n=None):
+    """ The heaviest users by distance, and artists and songs by plays """
+    n = n or app_config['top']['default_n']
+    logger.info(f"Request for the top {n} has started")
+    
+    with sketch_lock:
+        top = {name: [{'key': key, 'total': total, 'error': error} for key, total, error in counters.top(n)]
+               for name, counters in heavy_hitters.items()}
+    
+    logger.info("Request for the top has completed")
+    return top, 200
+
+def refresh_stats(stats):
+    """ Update the sketch estimates in stats and serve them, without touching disk """
+    with sketch_lock:
+        stats['percentiles'] = {name: {label: sketch.quantile(q) for label, q in QUANTILES.items()}
+                                for name, sketch in quantile_sketches.items()}
+        stats['distinct_users'] = distinct_users.count()
+    publish_stats(stats)
+
+def checkpoint_stats(stats):
+    """ Serve stats, then persist them with the timeseries, sketches and top counters """
+    refresh_stats(stats)
+    with series_lock:
+        stats['timeseries'] = {resolution: ring.to_dict() for resolution, ring in series.items()}
+    with sketch_lock:
+        stats['sketches'] = {name: sketch.to_dict() for name, sketch in quantile_sketches.items()}
+        stats['sketches']['distinct_users'] = distinct_users.to_dict()
+        stats['top'] = {name: counters.to_dict() for name, counters in heavy_hitters.items()}
+    # written outside the locks, so reads of /stats/timeseries and /stats/top never wait on disk
+    save_stats(stats)
+
+def init_stats():
+    """ Load the last checkpoint into memory and serve it """
+    global state, distinct_users
+    state = load_stats()
+    saved = state.get('timeseries', {})
+    for resolution, settings in app_config['timeseries'].items():
+        series[resolution] = RingSeries.from_dict(saved.get(resolution), settings['bucket_sec'], settings['buckets'])
+    
+    settings = app_config['sketches']
+    saved = state.get('sketches', {})
+    for name in SKETCHED_VALUES:
+        quantile_sketches[name] = DDSketch.from_dict(saved.get(name), settings['relative_accuracy'], settings['max_bins'])
+    distinct_users = HyperLogLog.from_dict(saved.get('distinct_users'), settings['hll_precision'])
+    
+    saved = state.get('top', {})
+    for name in HEAVY_HITTERS:
+        heavy_hitters[name] = SpaceSaving.from_dict(saved.get(name), app_config['top']['capacity'])
+    refresh_stats(state)
+
+def fetch_aggregate(path, start_timestamp, end_timestamp):
+    """ Get the aggregate of the events in [start, end) computed by Storage """
+    response = requests.get(
+        f"{app_config['eventstore']['url']}{path}",
+        params={'start_timestamp': start_timestamp, 'end_timestamp': end_timestamp}
+    )
+    logger.info(f"Aggregate request URL: {response.url}")
+    logger.info(f"Aggregate response status: {response.status_code}")
+    response.raise_for_status()
+    return response.json()
+
+def record(name, seconds, count, total, maximum):
+    """ Add events to the current bucket of every resolution """
+    with series_lock:
+        for ring in series.values():
+            ring.add(name, seconds, count, total, maximum)
+
+def record_event(event):
+    """ Add one event to the sketches and top counters, and to the timeseries in the bucket of its envelope datetime """
+    try:
+        seconds = parse_timestamp(event['datetime'])
+    except (KeyError, TypeError, ValueError):
+        seconds = parse_timestamp(datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"))
+    payload = event['payload']
+    if event['type'] == 'running_stats':
+        record('runs', seconds, 1, payload['duration'], payload['duration'])
+    elif event['type'] == 'music_info':
+        record('songs', seconds, 1, payload['song_duration'], payload['song_duration'])
+    
+    with sketch_lock:
+        for name, (type_name, field) in SKETCHED_VALUES.items():
+            if event['type'] == type_name:
+                quantile_sketches[name].add(payload[field])
+        distinct_users.add(payload['user_id'])
+        for name, (type_name, key, weight) in HEAVY_HITTERS.items():
+            if event['type'] == type_name:
+                heavy_hitters[name].add(key(payload), weight(payload))
+
+def populate_stats():
+    """ Periodically update stats """
+    logger.info("Start Periodic Processing")
+    # logger.info("DEMO ASSIGNMENT 3 - AFTER REPO")
+    global state
+    stats = copy.deepcopy(state)
+    # Polled totals no longer line up with offsets checkpointed by streaming mode
+    stats.pop('offsets', None)
     
     current_datetime = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
     
     try:
-        running_response = requests.get(
-            f"{app_config['eventstore']['url']}/stats/running",
-            params={'start_timestamp': stats['last_updated'], 'end_timestamp': current_datetime}
-        )
-        logger.info(f"Running stats request URL: {running_response.url}")  
-        logger.info(f"Running stats response status: {running_response.status_code}")  
-        running_response.raise_for_status()
-        running_data = running_response.json()
-        logger.info(f"Running data received: {running_data}")
+        running = fetch_aggregate("/stats/running/aggregate", stats['last_updated'], current_datetime)
+        logger.info(f"Running aggregate received: {running}")
+        new_run_count = running['count']
+        total_duration = running['sum_duration']
+        max_distance = running['max_distance']
+        max_duration = running['max_duration']
         
-        if running_data:
-            new_run_count = len(running_data)
-            total_duration = sum(run['duration'] for run in running_data)
-            
+        if new_run_count:
             # total count
             stats['num_running_stats'] += new_run_count
             
             # max values
-            stats['max_distance'] = max(stats['max_distance'], max(run['distance'] for run in running_data))
-            stats['max_duration'] = max(stats['max_duration'], max(run['duration'] for run in running_data))
+            stats['max_distance'] = max(stats['max_distance'], max_distance)
+            stats['max_duration'] = max(stats['max_duration'], max_duration)
             
             # average duration
             current_total = stats['avg_run_duration'] * (stats['num_running_stats'] - new_run_count)
             new_total = current_total + total_duration
             stats['avg_run_duration'] = new_total / stats['num_running_stats']
+            
+            # the whole window goes in the bucket it ends in
+            record('runs', parse_timestamp(current_datetime), new_run_count, total_duration, max_duration)
         
-        logger.info(f"Processed {len(running_data)} running stats")
+        logger.info(f"Processed {new_run_count} running stats")
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to retrieve running stats: {str(e)}")
     except Exception as e:
@@ -117,20 +309,12 @@ def populate_stats():
         logger.error(f"Error details: {traceback.format_exc()}")
     
     try:
-        music_response = requests.get(
-            f"{app_config['eventstore']['url']}/stats/music",
-            params={'start_timestamp': stats['last_updated'], 'end_timestamp': current_datetime}
-        )
-        logger.info(f"Music stats request URL: {music_response.url}")  
-        logger.info(f"Music stats response status: {music_response.status_code}")  
-        music_response.raise_for_status()
-        music_data = music_response.json()
-        logger.info(f"Music data received: {music_data}")
+        music = fetch_aggregate("/stats/music/aggregate", stats['last_updated'], current_datetime)
+        logger.info(f"Music aggregate received: {music}")
+        new_music_count = music['count']
+        total_song_duration = music['sum_song_duration']
         
-        if music_data:
-            new_music_count = len(music_data)
-            total_song_duration = sum(song['song_duration'] for song in music_data)
-            
+        if new_music_count:
             #  total count
             stats['num_music_info'] += new_music_count
             
@@ -138,22 +322,114 @@ def populate_stats():
             current_total = stats['avg_song_duration'] * (stats['num_music_info'] - new_music_count)
             new_total = current_total + total_song_duration
             stats['avg_song_duration'] = new_total / stats['num_music_info']
+            
+            # Storage does not aggregate the longest song, so its max stays 0 here
+            record('songs', parse_timestamp(current_datetime), new_music_count, total_song_duration, 0)
         
-        logger.info(f"Processed {len(music_data)} music info records")
+        logger.info(f"Processed {new_music_count} music info records")
     except requests.exceptions.RequestException as e:
         logger.error(f"Failed to retrieve music info: {str(e)}")
     except Exception as e:
         logger.error(f"Error processing music data: {str(e)}")
         logger.error(f"Error details: {traceback.format_exc()}")
     
+    stats['last_window'] = {'start': stats['last_updated'], 'end': current_datetime}
     stats['last_updated'] = current_datetime
     
-    with open(file_path, 'w') as f:  
-        json.dump(stats, f, indent=4)
+    checkpoint_stats(stats)
+    state = stats
     
     logger.info(f"Updated stats: {stats}")
     logger.info("End Periodic Processing")
 
+def apply_event(stats, event):
+    """ Fold one event into the counts, maxima and running averages """
+    payload = event['payload']
+    if event['type'] == 'running_stats':
+        stats['num_running_stats'] += 1
+        stats['max_distance'] = max(stats['max_distance'], payload['distance'])
+        stats['max_duration'] = max(stats['max_duration'], payload['duration'])
+        stats['avg_run_duration'] += (payload['duration'] - stats['avg_run_duration']) / stats['num_running_stats']
+    elif event['type'] == 'music_info':
+        stats['num_music_info'] += 1
+        stats['avg_song_duration'] += (payload['song_duration'] - stats['avg_song_duration']) / stats['num_music_info']
+
+def stream_stats():
+    """ Keep the stats up to date from the events topic, one message at a time
+
+    The stats served by /stats are refreshed in memory every
+    publish_interval_sec. Every checkpoint_interval_sec they are
+    checkpointed to disk together with the offset of the last message
+    folded into them for each partition. When the consumer is handed a
+    partition it resumes right after the checkpointed offset, so each event
+    is counted once even across restarts. Partitions without a checkpoint
+    start from the latest offset.
+    """
+    hostname = "%s:%d" % (app_config['events']['hostname'], app_config['events']['port'])
+    publish_interval = app_config['streaming']['publish_interval_sec']
+    checkpoint_interval = app_config['streaming']['checkpoint_interval_sec']
+
+    stats = state
+    offsets = {int(partition_id): offset for partition_id, offset in stats.get('offsets', {}).items()}
+
+    def restore_offsets(consumer, old_offsets, new_offsets):
+        return {partition_id: offsets[partition_id] for partition_id in new_offsets if partition_id in offsets}
+
+    while True:
+        consumer = None
+        try:
+            client = KafkaClient(hosts=hostname)
+            topic = client.topics[str.encode(app_config['events']['topic'])]
+            consumer = topic.get_balanced_consumer(consumer_group=str.encode(app_config['streaming']['consumer_group']),
+                                                   managed=True,
+                                                   auto_commit_enable=False,
+                                                   reset_offset_on_start=False,
+                                                   auto_offset_reset=OffsetType.LATEST,
+                                                   consumer_timeout_ms=publish_interval * 1000,
+                                                   post_rebalance_callback=restore_offsets)
+            logger.info("Streaming stats from Kafka")
+
+            # changed: not published yet, unsaved: not checkpointed yet
+            changed = unsaved = False
+            next_publish = time.time() + publish_interval
+            next_checkpoint = time.time() + checkpoint_interval
+            while True:
+                message = consumer.consume(block=True)
+                if message is not None:
+                    try:
+                        event = decode_event(message.value)
+                        apply_event(stats, event)
+                        record_event(event)
+                    except Exception as e:
+                        logger.error(f"Skipping message at partition {message.partition_id} offset {message.offset}: {str(e)}")
+                    offsets[message.partition_id] = message.offset
+                    changed = unsaved = True
+
+                now = time.time()
+                if now >= next_publish:
+                    if changed:
+                        stats['last_updated'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+                        refresh_stats(stats)
+                        changed = False
+                    next_publish = now + publish_interval
+
+                if now >= next_checkpoint:
+                    if unsaved:
+                        stats['offsets'] = offsets
+                        stats['last_updated'] = datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+                        checkpoint_stats(stats)
+                        # Only for lag monitoring; the checkpoint is what we resume from
+                        consumer.commit_offsets()
+                        changed = unsaved = False
+                    next_checkpoint = now + checkpoint_interval
+        except Exception as e:
+            logger.error(f"Error streaming stats: {str(e)}")
+            logger.error(f"Error details: {traceback.format_exc()}")
+            time.sleep(5)
+        finally:
+            if consumer is not None:
+                consumer.stop()
+
 def init_scheduler():
     sched = BackgroundScheduler(daemon=True)
     sched.add_job(populate_stats,
@@ -162,9 +438,13 @@ def init_scheduler():
     sched.start()
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/processing", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yaml", base_path="/processing", **validation.api_options(app_config))
 CORS(app.app)
 
 if __name__ == "__main__":
-    init_scheduler()
+    init_stats()
+    if app_config['mode'] == 'streaming':
+        Thread(target=stream_stats, daemon=True).start()
+    else:
+        init_scheduler()
     app.run(host="0.0.0.0",port=8100)
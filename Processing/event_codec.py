@@ -0,0 +1,228 @@
+"""Encoding of the {"type", "datetime", "payload"} envelope on the events topic
+
+Two wire formats are understood:
+
+* JSON, the original format. Messages start with ``{``.
+* Binary version 1. A header byte holding the format version, followed by
+  fixed-field struct packing of the numeric run/music fields and the UUIDs,
+  and length-prefixed UTF-8 for the free-form strings.
+
+decode_event() accepts both, so consumers keep reading the JSON messages
+already on the topic. A copy of this module lives in every service that
+touches the topic; keep them identical.
+"""
+import calendar
+import json
+import struct
+import time
+
+FORMAT_VERSION = 1
+
+DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+RUNNING_STATS = 1
+MUSIC_INFO = 2
+
+TYPE_CODES = {"running_stats": RUNNING_STATS, "music_info": MUSIC_INFO}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+RUNNING_FIELDS = {"user_id", "duration", "distance", "timestamp", "trace_id"}
+MUSIC_FIELDS = {"user_id", "song_name", "artist", "song_duration", "timestamp", "trace_id"}
+
+# version, type code, envelope datetime (epoch seconds), int flags
+HEADER = struct.Struct(">BBIB")
+# header, user_id, trace_id, duration, distance, timestamp length
+RUNNING_FIXED = struct.Struct(">BBIB16s16sddB")
+# header, user_id, trace_id, song_duration, timestamp/song_name/artist lengths
+MUSIC_FIXED = struct.Struct(">BBIB16s16sdBHH")
+
+# flags telling the decoder which numbers were ints before packing
+FLAG_INT_1 = 0x01
+FLAG_INT_2 = 0x02
+
+
+class NotPackable(Exception):
+    """The event does not fit the fixed binary layout"""
+
+
+# The envelope datetime only changes once a second, so remember the last
+# one packed and unpacked. Each cache is a (string, seconds) tuple that is
+# read once into a local and replaced whole, so a thread never sees a
+# string paired with another thread's seconds.
+_last_packed = (None, None)
+_last_unpacked = (None, None)
+
+
+def _pack_datetime(value):
+    global _last_packed
+    cached = _last_packed
+    if cached[0] == value:
+        return cached[1]
+    try:
+        created = calendar.timegm(time.strptime(value, DATETIME_FORMAT))
+    except (TypeError, ValueError):
+        raise NotPackable("envelope datetime not in the expected format")
+    if not 0 <= created < 2 ** 32:
+        raise NotPackable("envelope datetime out of range")
+    _last_packed = (value, created)
+    return created
+
+
+def _unpack_datetime(created):
+    global _last_unpacked
+    cached = _last_unpacked
+    if cached[1] == created:
+        return cached[0]
+    value = time.strftime(DATETIME_FORMAT, time.gmtime(created))
+    _last_unpacked = (value, created)
+    return value
+
+
+def _pack_uuid(value):
+    # bytes.fromhex is far cheaper than uuid.UUID; only the canonical
+    # lower-case form is packed so decoding gives back the same string
+    if len(value) != 36 or value[8] != "-" or value[13] != "-" or value[18] != "-" \
+            or value[23] != "-" or value != value.lower():
+        raise NotPackable(f"{value!r} is not a canonical uuid")
+    try:
+        return bytes.fromhex(value.replace("-", ""))
+    except ValueError:
+        raise NotPackable(f"{value!r} is not a canonical uuid")
+
+
+def _unpack_uuid(raw):
+    h = raw.hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+
+def _pack_number(value, flag):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise NotPackable(f"{value!r} is not a number")
+    if isinstance(value, int):
+        if abs(value) > 2 ** 53:
+            raise NotPackable(f"{value!r} does not fit a double")
+        return float(value), flag
+    return value, 0
+
+
+def _pack_str(value, limit):
+    raw = value.encode("utf-8")
+    if len(raw) > limit:
+        raise NotPackable("string too long")
+    return raw
+
+
+def _number(value, flags, flag):
+    return int(value) if flags & flag else value
+
+
+def _encode_binary(msg):
+    type_code = TYPE_CODES.get(msg.get("type"))
+    payload = msg.get("payload")
+    if type_code is None or not isinstance(payload, dict) or len(msg) != 3 or "datetime" not in msg:
+        raise NotPackable("unknown envelope")
+    created = _pack_datetime(msg["datetime"])
+
+    try:
+        if type_code == RUNNING_STATS:
+            if payload.keys() != RUNNING_FIELDS:
+                raise NotPackable("unexpected running_stats fields")
+            duration, f1 = _pack_number(payload["duration"], FLAG_INT_1)
+            distance, f2 = _pack_number(payload["distance"], FLAG_INT_2)
+            timestamp = _pack_str(payload["timestamp"], 0xFF)
+            return RUNNING_FIXED.pack(
+                FORMAT_VERSION, type_code, created, f1 | f2,
+                _pack_uuid(payload["user_id"]), _pack_uuid(payload["trace_id"]),
+                duration, distance, len(timestamp)) + timestamp
+
+        if payload.keys() != MUSIC_FIELDS:
+            raise NotPackable("unexpected music_info fields")
+        song_duration, f1 = _pack_number(payload["song_duration"], FLAG_INT_1)
+        timestamp = _pack_str(payload["timestamp"], 0xFF)
+        song_name = _pack_str(payload["song_name"], 0xFFFF)
+        artist = _pack_str(payload["artist"], 0xFFFF)
+        return MUSIC_FIXED.pack(
+            FORMAT_VERSION, type_code, created, f1,
+            _pack_uuid(payload["user_id"]), _pack_uuid(payload["trace_id"]),
+            song_duration, len(timestamp), len(song_name), len(artist)) + timestamp + song_name + artist
+    except (AttributeError, TypeError, ValueError, struct.error) as e:
+        raise NotPackable(str(e))
+
+
+def _decode_binary(data):
+    version, type_code = data[0], data[1]
+    if version != FORMAT_VERSION:
+        raise ValueError(f"Unsupported event format version {version}")
+
+    if type_code == RUNNING_STATS:
+        _, _, created, flags, user_id, trace_id, duration, distance, ts_len = RUNNING_FIXED.unpack_from(data)
+        offset = RUNNING_FIXED.size
+        payload = {
+            "user_id": _unpack_uuid(user_id),
+            "duration": _number(duration, flags, FLAG_INT_1),
+            "distance": _number(distance, flags, FLAG_INT_2),
+            "timestamp": data[offset:offset + ts_len].decode("utf-8"),
+            "trace_id": _unpack_uuid(trace_id),
+        }
+    elif type_code == MUSIC_INFO:
+        (_, _, created, flags, user_id, trace_id, song_duration,
+         ts_len, name_len, artist_len) = MUSIC_FIXED.unpack_from(data)
+        offset = MUSIC_FIXED.size
+        name_start = offset + ts_len
+        artist_start = name_start + name_len
+        payload = {
+            "user_id": _unpack_uuid(user_id),
+            "song_name": data[name_start:artist_start].decode("utf-8"),
+            "artist": data[artist_start:artist_start + artist_len].decode("utf-8"),
+            "song_duration": _number(song_duration, flags, FLAG_INT_1),
+            "timestamp": data[offset:name_start].decode("utf-8"),
+            "trace_id": _unpack_uuid(trace_id),
+        }
+    else:
+        raise ValueError(f"Unknown event type code {type_code}")
+
+    return {
+        "type": TYPE_NAMES[type_code],
+        "datetime": _unpack_datetime(created),
+        "payload": payload,
+    }
+
+
+def encode_event(msg, codec="binary"):
+    """Serialize an event envelope to bytes
+
+    With the binary codec, events that do not fit the fixed layout (extra
+    fields, non-uuid ids, ...) are written as JSON so nothing is lost.
+    """
+    if codec == "binary":
+        try:
+            return _encode_binary(msg)
+        except NotPackable:
+            pass
+    elif codec != "json":
+        raise ValueError(f"Unknown event codec {codec!r}")
+    return json.dumps(msg).encode("utf-8")
+
+
+def decode_event(data):
+    """Deserialize bytes from the topic, whatever format they were written in
+
+    Raises ValueError for messages that cannot be decoded.
+    """
+    if not data:
+        raise ValueError("Empty event")
+    if data[:1] == b"{":
+        return json.loads(data.decode("utf-8"))
+    try:
+        return _decode_binary(data)
+    except (struct.error, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Corrupt binary event: {e}")
+
+
+def event_type(data):
+    """Return the event type without decoding the payload of binary events"""
+    if data[:1] == b"{":
+        return decode_event(data)["type"]
+    if len(data) < HEADER.size or data[0] != FORMAT_VERSION or data[1] not in TYPE_NAMES:
+        raise ValueError("Corrupt binary event")
+    return TYPE_NAMES[data[1]]
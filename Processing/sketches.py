@@ -0,0 +1,216 @@
+"""Mergeable streaming sketches kept by Processing
+
+DDSketch estimates quantiles of a stream of positive numbers to within a
+relative error: every value is counted in the logarithmic bin it falls
+in, and a quantile is read back from the bin holding that rank. The
+number of bins is capped, so memory stays constant however many values
+are added; past the cap the lowest bins are folded together, which only
+costs accuracy at the low end.
+
+HyperLogLog estimates the number of distinct strings seen from a fixed
+array of registers (16 KiB at the default precision of 14, with a
+standard error of about 0.8%).
+
+SpaceSaving keeps running totals for the heaviest keys of a stream (top
+users, artists, songs) in a fixed number of counters.
+
+All of them merge (adding bins / counters, taking register maxima) and
+serialize to JSON-friendly dicts for the stats checkpoint.
+"""
+import base64
+import hashlib
+import heapq
+import math
+
+
+class DDSketch:
+    """ Quantiles of positive values with a bounded relative error """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.bins = {}
+        # values too small to have a bin, zero included
+        self.zero_count = 0
+        self.count = 0
+
+    def add(self, value, count=1):
+        if value <= 1e-9:
+            self.zero_count += count
+        else:
+            key = math.ceil(math.log(value) / self.log_gamma)
+            self.bins[key] = self.bins.get(key, 0) + count
+            if len(self.bins) > self.max_bins:
+                self.collapse()
+        self.count += count
+
+    def collapse(self):
+        """ Fold the lowest bins into one so at most max_bins are left """
+        keys = sorted(self.bins)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        folded = sum(self.bins.pop(key) for key in excess)
+        self.bins[excess[-1]] = folded
+
+    def merge(self, other):
+        for key, count in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if len(self.bins) > self.max_bins:
+            self.collapse()
+
+    def quantile(self, q):
+        """ Estimate of the q quantile, None while the sketch is empty """
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def to_dict(self):
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'max_bins': self.max_bins,
+            'zero_count': self.zero_count,
+            'count': self.count,
+            'bins': {str(key): count for key, count in self.bins.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data, relative_accuracy=0.01, max_bins=2048):
+        """ Restore a checkpointed sketch. Starts empty if its accuracy no longer matches """
+        sketch = cls(relative_accuracy, max_bins)
+        if not data or data.get('relative_accuracy') != relative_accuracy:
+            return sketch
+        sketch.bins = {int(key): count for key, count in data['bins'].items()}
+        sketch.zero_count = data['zero_count']
+        sketch.count = data['count']
+        if len(sketch.bins) > max_bins:
+            sketch.collapse()
+        return sketch
+
+
+class HyperLogLog:
+    """ Approximate count of distinct strings """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.size = 1 << precision
+        self.registers = bytearray(self.size)
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.blake2b(value.encode('utf-8'), digest_size=8).digest(), 'big')
+        index = hashed >> (64 - self.precision)
+        rest = hashed & ((1 << (64 - self.precision)) - 1)
+        # position of the first 1 bit in the remaining 64 - precision bits
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def count(self):
+        alpha = 0.7213 / (1 + 1.079 / self.size)
+        estimate = alpha * self.size * self.size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * self.size and zeros:
+            # linear counting is more accurate while many registers are empty
+            estimate = self.size * math.log(self.size / zeros)
+        return round(estimate)
+
+    def to_dict(self):
+        return {'precision': self.precision,
+                'registers': base64.b64encode(bytes(self.registers)).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, data, precision=14):
+        """ Restore a checkpointed sketch. Starts empty if its precision no longer matches """
+        sketch = cls(precision)
+        if data and data.get('precision') == precision:
+            sketch.registers = bytearray(base64.b64decode(data['registers']))
+        return sketch
+
+
+class SpaceSaving:
+    """ The heaviest keys of a stream, with at most capacity counters
+
+    A key that is not counted yet takes over the counter of the lightest
+    key once all counters are in use, inheriting its total as the error.
+    Each reported total is then at most `error` above the true one, and
+    any key whose true total is over 1/capacity of the sum of all weights
+    is guaranteed to be counted. The lightest counter is found with a
+    heap of (total, key) pairs whose stale entries are skipped, and which
+    is rebuilt once it grows past a few times capacity.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.totals = {}
+        self.errors = {}
+        self.heap = []
+
+    def add(self, key, weight=1):
+        if key in self.totals:
+            self.totals[key] += weight
+        elif len(self.totals) < self.capacity:
+            self.totals[key] = weight
+            self.errors[key] = 0
+        else:
+            lightest, evicted = self.pop_lightest()
+            del self.totals[evicted], self.errors[evicted]
+            self.totals[key] = lightest + weight
+            self.errors[key] = lightest
+        heapq.heappush(self.heap, (self.totals[key], key))
+        if len(self.heap) > 4 * self.capacity:
+            self.rebuild_heap()
+
+    def pop_lightest(self):
+        while True:
+            total, key = heapq.heappop(self.heap)
+            if self.totals.get(key) == total:
+                return total, key
+
+    def rebuild_heap(self):
+        self.heap = [(total, key) for key, total in self.totals.items()]
+        heapq.heapify(self.heap)
+
+    def merge(self, other):
+        """ Add the counters of other, keeping the capacity heaviest """
+        for key, total in other.totals.items():
+            self.totals[key] = self.totals.get(key, 0) + total
+            self.errors[key] = self.errors.get(key, 0) + other.errors[key]
+        for key in sorted(self.totals, key=self.totals.get)[:max(len(self.totals) - self.capacity, 0)]:
+            del self.totals[key], self.errors[key]
+        self.rebuild_heap()
+
+    def top(self, n):
+        """ The n heaviest keys as (key, total, error), heaviest first """
+        keys = heapq.nlargest(n, self.totals, key=self.totals.get)
+        return [(key, self.totals[key], self.errors[key]) for key in keys]
+
+    def to_dict(self):
+        return {'capacity': self.capacity,
+                'counters': [[key, total, self.errors[key]] for key, total in self.totals.items()]}
+
+    @classmethod
+    def from_dict(cls, data, capacity=1000):
+        """ Restore checkpointed counters, keeping the capacity heaviest """
+        sketch = cls(capacity)
+        if data:
+            restored = cls(len(data['counters']) or 1)
+            for key, total, error in data['counters']:
+                restored.totals[key] = total
+                restored.errors[key] = error
+            sketch.merge(restored)
+        return sketch
@@ -0,0 +1,129 @@
+"""Fixed-size ring buffers of per-bucket event counts, sums and maxima
+
+A RingSeries covers the last `buckets` buckets of `bucket_sec` seconds
+each. Every bucket holds, for runs and for songs, the number of events,
+the total duration and the longest duration. The values live in flat
+arrays of `buckets` slots allocated up front, so memory does not grow
+with the number of events: bucket N is kept in slot N % buckets and is
+cleared when a newer bucket wraps around onto its slot.
+
+Times are whole seconds since the epoch of the naive "%Y-%m-%dT%H:%M:%S"
+timestamps used on the events topic and by Storage.
+"""
+import base64
+import calendar
+import time
+from array import array
+
+SERIES = ('runs', 'songs')
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def parse_timestamp(value):
+    """ Seconds since the epoch of a timestamp with or without the trailing Z """
+    return calendar.timegm(time.strptime(value.rstrip('Z'), "%Y-%m-%dT%H:%M:%S"))
+
+
+def format_timestamp(seconds):
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime(seconds))
+
+
+class RingSeries:
+    """ The last `buckets` buckets of `bucket_sec` seconds """
+
+    def __init__(self, bucket_sec, buckets):
+        self.bucket_sec = bucket_sec
+        self.buckets = buckets
+        # bucket number held by each slot, -1 while the slot is unused
+        self.bucket_ids = array('q', [-1]) * buckets
+        self.counts = {name: array('q', [0]) * buckets for name in SERIES}
+        self.sums = {name: array('d', [0.0]) * buckets for name in SERIES}
+        self.maxima = {name: array('d', [0.0]) * buckets for name in SERIES}
+        self.latest = -1
+
+    def slot(self, bucket, create=False):
+        """ Slot holding bucket, or None. With create, clears the slot for it if needed """
+        slot = bucket % self.buckets
+        if self.bucket_ids[slot] == bucket:
+            return slot
+        if not create or bucket <= self.latest - self.buckets:
+            return None
+        self.bucket_ids[slot] = bucket
+        for name in SERIES:
+            self.counts[name][slot] = 0
+            self.sums[name][slot] = 0.0
+            self.maxima[name][slot] = 0.0
+        self.latest = max(self.latest, bucket)
+        return slot
+
+    def add(self, name, seconds, count, total, maximum):
+        """ Add count events totalling total, the longest being maximum, at seconds """
+        slot = self.slot(seconds // self.bucket_sec, create=True)
+        if slot is None:
+            # older than the whole ring
+            return
+        self.counts[name][slot] += count
+        self.sums[name][slot] += total
+        self.maxima[name][slot] = max(self.maxima[name][slot], maximum)
+
+    def query(self, start=None, end=None):
+        """ The buckets starting in [start, end], oldest first, clipped to the ring
+
+        Buckets without events are included with zeroes.
+        """
+        if self.latest < 0:
+            return []
+        first = self.latest - self.buckets + 1
+        last = self.latest
+        if start is not None:
+            first = max(first, -(-start // self.bucket_sec))
+        if end is not None:
+            last = min(last, end // self.bucket_sec)
+
+        results = []
+        for bucket in range(first, last + 1):
+            slot = self.slot(bucket)
+            entry = {'start': format_timestamp(bucket * self.bucket_sec)}
+            for name in SERIES:
+                if slot is None:
+                    entry[name] = {'count': 0, 'sum': 0.0, 'max': 0.0}
+                else:
+                    entry[name] = {'count': self.counts[name][slot],
+                                   'sum': self.sums[name][slot],
+                                   'max': self.maxima[name][slot]}
+            results.append(entry)
+        return results
+
+    def to_dict(self):
+        """ Compact, JSON-serializable form for the stats checkpoint """
+        def encode(values):
+            return base64.b64encode(values.tobytes()).decode('ascii')
+
+        return {
+            'bucket_sec': self.bucket_sec,
+            'buckets': self.buckets,
+            'latest': self.latest,
+            'bucket_ids': encode(self.bucket_ids),
+            'counts': {name: encode(self.counts[name]) for name in SERIES},
+            'sums': {name: encode(self.sums[name]) for name in SERIES},
+            'maxima': {name: encode(self.maxima[name]) for name in SERIES},
+        }
+
+    @classmethod
+    def from_dict(cls, data, bucket_sec, buckets):
+        """ Restore a checkpointed series. Starts empty if its shape no longer matches """
+        series = cls(bucket_sec, buckets)
+        if not data or data.get('bucket_sec') != bucket_sec or data.get('buckets') != buckets:
+            return series
+
+        def decode(values, encoded):
+            values[:] = array(values.typecode, base64.b64decode(encoded))
+
+        decode(series.bucket_ids, data['bucket_ids'])
+        for name in SERIES:
+            decode(series.counts[name], data['counts'][name])
+            decode(series.sums[name], data['sums'][name])
+            decode(series.maxima[name], data['maxima'][name])
+        series.latest = data['latest']
+        return series
@@ -4,12 +4,23 @@ from datetime import datetime
 import json
 import requests
 import yaml
+import validation
 import logging
 import logging.config
 import uuid
 import time
+import queue
+import fcntl
+import glob
+import re
+import contextlib
+import threading
+from collections import deque
 from pykafka import KafkaClient
+from pykafka.partitioners import hashing_partitioner
+from event_codec import encode_event
 import os
+import uvicorn
 
 if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
     print("In Test Environment")
@@ -34,92 +45,602 @@ logger.info("Log Conf File: %s" % log_conf_file)
 kafka_client = None
 kafka_topic = None
 kafka_producer = None
+kafka_batch_producer = None
 
-def get_kafka_client():
-    """Get or create Kafka client with retry logic"""
-    global kafka_client, kafka_topic, kafka_producer
-    
-    if kafka_client is None:
-        retry_count = 0
-        max_retries = 3
-        while retry_count < max_retries:
+kafka_lock = threading.Lock()
+
+def make_batch_producer(topic):
+    """Async producer with delivery reports for the batch endpoints"""
+    # No producer-side retries: pykafka re-queues a failed message behind
+    # newer ones, which would break per-user ordering. Failed batches go
+    # to the spool instead.
+    return topic.get_producer(
+        sync=False,
+        delivery_reports=True,
+        partitioner=hashing_partitioner,
+        max_retries=0,
+        linger_ms=app_config['events']['batch']['linger_ms'],
+        min_queued_messages=app_config['events']['batch']['max_records'])
+
+def restart_batch_producer(producer):
+    """Swap in a new batch producer and stop producer
+
+    stop() waits until every message producer still holds is delivered or
+    failed (up to pykafka's pending_timeout_ms) and then never sends
+    again, so afterwards its delivery reports are final. If no new
+    producer can be made, the connection is dropped so the spool drainer
+    reconnects.
+    """
+    global kafka_client, kafka_batch_producer
+    with kafka_lock:
+        if kafka_batch_producer is producer:
             try:
-                logger.info(f"Attempting to connect to Kafka \
-                            (attempt {retry_count + 1}/{max_retries})")
-                kafka_client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
-                kafka_topic = kafka_client.topics[str.encode(app_config['events']['topic'])]
-                kafka_producer = kafka_topic.get_sync_producer()
-                logger.info("Successfully connected to Kafka")
-                return kafka_producer
+                kafka_batch_producer = make_batch_producer(kafka_topic)
             except Exception as e:
-                logger.error(f"Failed to connect to Kafka: {str(e)}")
-                retry_count += 1
-                if retry_count < max_retries:
-                    logger.info(f"Retrying in 5 seconds...")
-                    time.sleep(5)
-                else:
-                    raise Exception("Failed to connect to Kafka after maximum retries")
-    
+                logger.error(f"Failed to restart the batch producer: {str(e)}")
+                kafka_client = None
+    try:
+        producer.stop()
+    except Exception as e:
+        logger.error(f"Error stopping the batch producer: {str(e)}")
+
+def connect_kafka():
+    """Create the Kafka client and producers if they do not exist yet"""
+    global kafka_client, kafka_topic, kafka_producer, kafka_batch_producer
+
+    with kafka_lock:
+        if kafka_client is not None:
+            return kafka_producer
+        try:
+            logger.info("Attempting to connect to Kafka")
+            client = KafkaClient(hosts=f"{app_config['events']['hostname']}:{app_config['events']['port']}")
+            kafka_topic = client.topics[str.encode(app_config['events']['topic'])]
+            kafka_producer = kafka_topic.get_sync_producer(partitioner=hashing_partitioner)
+            kafka_batch_producer = make_batch_producer(kafka_topic)
+            kafka_client = client
+            logger.info("Successfully connected to Kafka")
+            return kafka_producer
+        except Exception as e:
+            logger.error(f"Failed to connect to Kafka: {str(e)}")
+            raise
+
+def get_kafka_client():
+    """Get the Kafka producer without ever blocking on a reconnect
+
+    Connecting is left to startup and the spool drainer, so request threads
+    fail fast and spool their events while the broker is unreachable.
+    """
+    if kafka_client is None:
+        raise Exception("Kafka is not connected")
     return kafka_producer
 
+def build_event(event_type, body):
+    """Wrap a record in the event envelope and give it its own trace id"""
+    trace_id = str(uuid.uuid4())
+    body['trace_id'] = trace_id
+    return {
+        "type": event_type,
+        "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+        "payload": body,
+    }
+
+def partition_key(msg):
+    """Key events by user so each user's events stay ordered in one partition"""
+    return msg['payload']['user_id'].encode('utf-8')
+
+def publish_batch(msgs):
+    """Produce a list of events in one bulk request and wait for every ack
+
+    Returns the events that were not delivered, in their original order, so
+    the caller spools only those: events Kafka acknowledged are not sent
+    again. If some are still unacknowledged at the timeout, the producer is
+    stopped (and replaced) first, so it cannot deliver them after they were
+    spooled; whatever it has not reported as delivered by then is spooled.
+    Delivery reports in pykafka are kept per producing thread, so
+    concurrent batch requests only ever see the reports for their own
+    messages.
+    """
+    get_kafka_client()
+    producer = kafka_batch_producer
+
+    # id of the pykafka message -> (index in msgs, message)
+    pending = {}
+    failed = []
+    errors = []
+    for i, msg in enumerate(msgs):
+        try:
+            kafka_msg = producer.produce(encode_event(msg, app_config['events']['codec']),
+                                         partition_key=partition_key(msg))
+        except Exception as e:
+            errors.append(str(e))
+            failed.extend(range(i, len(msgs)))
+            break
+        pending[id(kafka_msg)] = (i, kafka_msg)
+
+    def record_report(kafka_msg, exc):
+        entry = pending.pop(id(kafka_msg), None)
+        if entry is not None and exc is not None:
+            errors.append(str(exc))
+            failed.append(entry[0])
+
+    deadline = time.time() + app_config['events']['batch']['delivery_timeout_sec']
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        try:
+            record_report(*producer.get_delivery_report(timeout=remaining))
+        except queue.Empty:
+            continue
+
+    if pending:
+        logger.error(f"Timed out waiting for {len(pending)} delivery reports, stopping the batch producer")
+        restart_batch_producer(producer)
+        while pending:
+            try:
+                record_report(*producer.get_delivery_report(block=False))
+            except queue.Empty:
+                break
+        if pending:
+            errors.append(f"{len(pending)} events were never sent")
+            failed.extend(i for i, _ in pending.values())
+
+    if failed:
+        logger.error(f"{len(failed)} of {len(msgs)} events not delivered: {errors[0]}")
+    return [msgs[i] for i in sorted(failed)]
+
+spool_lock = threading.Lock()
+spool_state = {"filename": None, "depth": 0, "oldest": None, "read_pos": 0}
+spool_slot_handle = None
+
+def claim_spool_slot():
+    """Lock the first spool file no other worker holds
+
+    Slots are numbered, so a restarted worker picks up a spool left behind
+    by whichever worker held that slot before.
+    """
+    global spool_slot_handle
+    base, ext = os.path.splitext(app_config['spool']['filename'])
+    os.makedirs(os.path.dirname(base) or '.', exist_ok=True)
+
+    slot = 0
+    while True:
+        handle = open(f"{base}.{slot}.lock", 'w')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            slot += 1
+            continue
+        spool_slot_handle = handle
+        return f"{base}.{slot}{ext}"
+
+def spool_offset_file():
+    return spool_state['filename'] + ".pos"
+
+def parse_spool_line(line, filename, pos):
+    """Decode one spool record, or log and return None if it is corrupt"""
+    try:
+        record = json.loads(line)
+        if not isinstance(record, dict) or 'spooled_at' not in record or 'event' not in record:
+            raise ValueError("not a spool record")
+        return record
+    except ValueError as e:
+        logger.error(f"Skipping corrupt spool record at {filename}:{pos}: {str(e)}")
+        return None
+
+def load_spool():
+    """Rebuild spool depth and age from the file left by a previous run
+
+    A crash in the middle of an append leaves a last line without its
+    newline; nothing else writes to this slot yet, so it is cut off rather
+    than left to block the drainer.
+    """
+    filename = claim_spool_slot()
+    spool_state['filename'] = filename
+    read_pos = 0
+    if os.path.exists(spool_offset_file()):
+        with open(spool_offset_file(), 'r') as f:
+            read_pos = int(f.read().strip() or 0)
+
+    depth = 0
+    oldest = None
+    if os.path.exists(filename):
+        with open(filename, 'r+b') as f:
+            f.seek(read_pos)
+            pos = read_pos
+            for line in f:
+                if not line.endswith(b"\n"):
+                    logger.error(f"Truncating torn last spool record at {filename}:{pos} ({len(line)} bytes)")
+                    f.truncate(pos)
+                    break
+                record = parse_spool_line(line, filename, pos)
+                pos += len(line)
+                if record is None:
+                    continue
+                if oldest is None:
+                    oldest = record['spooled_at']
+                depth += 1
+
+    with spool_lock:
+        spool_state.update(depth=depth, oldest=oldest, read_pos=read_pos)
+    if depth:
+        logger.info(f"Found {depth} spooled events waiting to be replayed")
+
+def spool_events(msgs):
+    """Append events to the on-disk spool until Kafka can take them"""
+    now = time.time()
+    lines = b"".join(
+        json.dumps({"spooled_at": now, "event": msg}).encode('utf-8') + b"\n" for msg in msgs)
+
+    with spool_lock:
+        with open(spool_state['filename'], 'ab') as f:
+            f.write(lines)
+            f.flush()
+        spool_state['depth'] += len(msgs)
+        if spool_state['oldest'] is None:
+            spool_state['oldest'] = now
+    logger.warning(f"Spooled {len(msgs)} events to disk")
+
+def spool_has_backlog():
+    with spool_lock:
+        return spool_state['depth'] > 0
+
+def read_spool_chunk(filename, read_pos):
+    """Read up to a batch of events from read_pos
+
+    Returns the events, the position after them and the spooled_at time of
+    the next record, if there is one.
+    """
+    msgs = []
+    next_oldest = None
+    with open(filename, 'rb') as f:
+        f.seek(read_pos)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # A concurrent append is still being written
+                break
+            record = parse_spool_line(line, filename, read_pos)
+            if record is None:
+                # corrupt records are skipped so they cannot hold up the rest
+                read_pos += len(line)
+                continue
+            if len(msgs) >= app_config['events']['batch']['max_records']:
+                next_oldest = record['spooled_at']
+                break
+            msgs.append(record['event'])
+            read_pos += len(line)
+    return msgs, read_pos, next_oldest
+
+def drain_spool_once():
+    """Replay the oldest chunk of the spool in order, return events replayed"""
+    filename = spool_state['filename']
+    with spool_lock:
+        read_pos = spool_state['read_pos']
+
+    msgs, read_pos, next_oldest = read_spool_chunk(filename, read_pos)
+    if not msgs:
+        with spool_lock:
+            if read_pos > spool_state['read_pos']:
+                spool_state['read_pos'] = read_pos
+                with open(spool_offset_file(), 'w') as f:
+                    f.write(str(read_pos))
+        return 0
+
+    # Acknowledged events are not sent again; the rest go back on the end of the spool
+    failed = publish_batch(msgs)
+    if failed:
+        spool_events(failed)
+
+    with spool_lock:
+        spool_state['depth'] -= len(msgs)
+        spool_state['read_pos'] = read_pos
+        if spool_state['depth'] == 0:
+            # Everything has been replayed, start over with an empty file
+            open(filename, 'wb').close()
+            spool_state.update(read_pos=0, oldest=None)
+        else:
+            spool_state['oldest'] = next_oldest or time.time()
+        with open(spool_offset_file(), 'w') as f:
+            f.write(str(spool_state['read_pos']))
+    if failed:
+        # let the drainer back off rather than spin on a broker that is failing
+        raise Exception(f"{len(failed)} of {len(msgs)} spooled events not delivered")
+    return len(msgs)
+
+def orphaned_spools():
+    """Spool files of every slot other than this worker's, as (spool, lock file)"""
+    base, ext = os.path.splitext(app_config['spool']['filename'])
+    slot_pattern = re.compile(re.escape(base) + r"\.(\d+)" + re.escape(ext) + "$")
+    for filename in sorted(glob.glob(f"{glob.escape(base)}.*{ext}")):
+        match = slot_pattern.match(filename)
+        if match and filename != spool_state['filename']:
+            yield filename, f"{base}.{match.group(1)}.lock"
+
+def drain_orphaned_spool(filename, lock_filename):
+    """Replay and remove a spool no worker holds, return events replayed
+
+    Left behind when serving.workers is lowered or a worker is not
+    restarted. Events that fail again go to this worker's own spool.
+    """
+    handle = open(lock_filename, 'w')
+    try:
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        # a running worker owns this slot and drains it itself
+        handle.close()
+        return 0
+
+    try:
+        offset_file = filename + ".pos"
+        read_pos = 0
+        if os.path.exists(offset_file):
+            with open(offset_file, 'r') as f:
+                read_pos = int(f.read().strip() or 0)
+
+        replayed = 0
+        while True:
+            msgs, read_pos, _ = read_spool_chunk(filename, read_pos)
+            if not msgs:
+                break
+            failed = publish_batch(msgs)
+            if failed:
+                spool_events(failed)
+            with open(offset_file, 'w') as f:
+                f.write(str(read_pos))
+            replayed += len(msgs)
+
+        if os.path.getsize(filename) > read_pos:
+            logger.error(f"Discarding torn last record of {filename} at {read_pos}")
+        os.remove(filename)
+        if os.path.exists(offset_file):
+            os.remove(offset_file)
+        return replayed
+    finally:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+def spool_drainer():
+    """Keep Kafka connected and replay spooled events once it is back
+
+    Besides its own spool, every worker replays the spools of slots no
+    running worker holds.
+    """
+    while True:
+        try:
+            connect_kafka()
+            while spool_has_backlog():
+                replayed = drain_spool_once()
+                if not replayed:
+                    break
+                logger.info(f"Replayed {replayed} spooled events")
+            for filename, lock_filename in orphaned_spools():
+                replayed = drain_orphaned_spool(filename, lock_filename)
+                if replayed:
+                    logger.info(f"Replayed {replayed} events from orphaned spool {filename}")
+        except Exception as e:
+            logger.error(f"Spool drainer waiting for Kafka: {str(e)}")
+        time.sleep(app_config['spool']['drain_interval_sec'])
+
+def start_spool_drainer():
+    load_spool()
+    t = threading.Thread(target=spool_drainer, name="spool-drainer", daemon=True)
+    t.start()
+
+class ProducerBufferFull(Exception):
+    """Raised when the async producer buffer has no room for more events"""
+
+event_buffer = deque()
+buffer_cond = threading.Condition()
+producer_stats = {"delivered": 0, "failed": 0, "rejected": 0, "last_error": None}
+stats_lock = threading.Lock()
+
+def enqueue_events(msgs):
+    """Add events to the bounded buffer, all or nothing"""
+    capacity = app_config['events']['producer']['queue_size']
+    with buffer_cond:
+        if len(event_buffer) + len(msgs) > capacity:
+            with stats_lock:
+                producer_stats['rejected'] += len(msgs)
+            raise ProducerBufferFull(f"Producer buffer full ({len(event_buffer)}/{capacity} events)")
+        event_buffer.extend(msgs)
+        buffer_cond.notify()
+
+def next_buffered_batch():
+    """Block until events are buffered, then linger for a full batch"""
+    batch_size = app_config['events']['producer']['batch_size']
+    linger_sec = app_config['events']['producer']['linger_ms'] / 1000
+
+    with buffer_cond:
+        while not event_buffer:
+            buffer_cond.wait()
+
+        deadline = time.time() + linger_sec
+        while len(event_buffer) < batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            buffer_cond.wait(remaining)
+
+        return [event_buffer.popleft() for _ in range(min(batch_size, len(event_buffer)))]
+
+def publisher_loop():
+    """Drain the event buffer into Kafka and track delivery reports"""
+    while True:
+        batch = next_buffered_batch()
+        if spool_has_backlog():
+            # Keep ordering: nothing overtakes events already waiting on disk
+            spool_events(batch)
+            continue
+        try:
+            failed = publish_batch(batch)
+            error = f"{len(failed)} of {len(batch)} events not delivered"
+        except Exception as e:
+            failed = batch
+            error = str(e)
+        with stats_lock:
+            producer_stats['delivered'] += len(batch) - len(failed)
+            producer_stats['failed'] += len(failed)
+            if failed:
+                producer_stats['last_error'] = error
+        if failed:
+            logger.error(f"Failed to deliver {len(failed)} of {len(batch)} events: {error}")
+            spool_events(failed)
+        else:
+            logger.debug(f"Delivered batch of {len(batch)} events")
+
+def start_publisher():
+    """Start the background publisher when running in async mode"""
+    if app_config['events']['producer']['mode'] != 'async':
+        return
+    t = threading.Thread(target=publisher_loop, name="kafka-publisher", daemon=True)
+    t.start()
+    logger.info("Started async Kafka publisher")
+
+def submit_events(msgs):
+    """Hand events to Kafka according to the configured producer mode"""
+    if app_config['events']['producer']['mode'] == 'async':
+        enqueue_events(msgs)
+        return
+
+    if spool_has_backlog():
+        spool_events(msgs)
+        return
+
+    try:
+        if len(msgs) == 1:
+            producer = get_kafka_client()
+            producer.produce(encode_event(msgs[0], app_config['events']['codec']),
+                             partition_key=partition_key(msgs[0]))
+        else:
+            failed = publish_batch(msgs)
+            if failed:
+                spool_events(failed)
+    except Exception as e:
+        logger.error(f"Kafka produce failed, spooling {len(msgs)} events: {str(e)}")
+        spool_events(msgs)
+
 def running_stats(body):
     """Forward running data to the storage service"""
-    trace_id = str(uuid.uuid4())
+    msg = build_event("running_stats", body)
+    trace_id = msg['payload']['trace_id']
     logger.info(f"Received running data with a unique id of {trace_id}")
 
     try:
-        producer = get_kafka_client()
-        
-        msg = {
-            "type": "running_stats",
-            "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "payload": body,
-        }
-        msg['payload']['trace_id'] = trace_id
-        msg_str = json.dumps(msg)
-        producer.produce(msg_str.encode('utf-8'))
+        submit_events([msg])
         
         logger.info(f"Returned event running_stats response (Id: {trace_id}) with status 201")
         return NoContent, 201
+    except ProducerBufferFull as e:
+        logger.warning(f"Rejected running stats: {str(e)}")
+        return {"message": "Service Unavailable"}, 503, {"Retry-After": "1"}
     except Exception as e:
         logger.error(f"Failed to process running stats: {str(e)}")
         return {"message": "Internal Server Error"}, 500
 
 def music_info(body):
     """Forward music data to the storage service"""
-    trace_id = str(uuid.uuid4())
+    msg = build_event("music_info", body)
+    trace_id = msg['payload']['trace_id']
     logger.info(f"Received music data with a unique id of {trace_id}")
 
     try:
-        producer = get_kafka_client()
-        
-        msg = {
-            "type": "music_info",
-            "datetime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
-            "payload": body,
-        }
-        msg['payload']['trace_id'] = trace_id
-        msg_str = json.dumps(msg)
-        producer.produce(msg_str.encode('utf-8'))
+        submit_events([msg])
         
         logger.info(f"Returned event music_info response (Id: {trace_id}) with status 201")
         return NoContent, 201
+    except ProducerBufferFull as e:
+        logger.warning(f"Rejected music info: {str(e)}")
+        return {"message": "Service Unavailable"}, 503, {"Retry-After": "1"}
     except Exception as e:
         logger.error(f"Failed to process music info: {str(e)}")
         return {"message": "Internal Server Error"}, 500
 
-app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/receiver", strict_validation=True, validate_responses=True)
+def running_stats_batch(body):
+    """Forward a batch of running records to Kafka in one bulk produce"""
+    msgs = [build_event("running_stats", record) for record in body]
+    trace_ids = [msg['payload']['trace_id'] for msg in msgs]
+    logger.info(f"Received batch of {len(msgs)} running records")
 
-# new endpoint that returns the health status of the service
-def get_check():
-    return NoContent, 200
+    try:
+        submit_events(msgs)
 
-if __name__ == "__main__":
+        logger.info(f"Returned event running_stats batch response ({len(msgs)} events) with status 201")
+        return {"trace_ids": trace_ids}, 201
+    except ProducerBufferFull as e:
+        logger.warning(f"Rejected running stats batch: {str(e)}")
+        return {"message": "Service Unavailable"}, 503, {"Retry-After": "1"}
+    except Exception as e:
+        logger.error(f"Failed to process running stats batch: {str(e)}")
+        return {"message": "Internal Server Error"}, 500
+
+def music_info_batch(body):
+    """Forward a batch of music records to Kafka in one bulk produce"""
+    msgs = [build_event("music_info", record) for record in body]
+    trace_ids = [msg['payload']['trace_id'] for msg in msgs]
+    logger.info(f"Received batch of {len(msgs)} music records")
+
+    try:
+        submit_events(msgs)
+
+        logger.info(f"Returned event music_info batch response ({len(msgs)} events) with status 201")
+        return {"trace_ids": trace_ids}, 201
+    except ProducerBufferFull as e:
+        logger.warning(f"Rejected music info batch: {str(e)}")
+        return {"message": "Service Unavailable"}, 503, {"Retry-After": "1"}
+    except Exception as e:
+        logger.error(f"Failed to process music info batch: {str(e)}")
+        return {"message": "Internal Server Error"}, 500
+
+def get_producer_status():
+    """Report producer mode, buffer depth and delivery counters"""
+    with buffer_cond:
+        depth = len(event_buffer)
+    with stats_lock:
+        status = dict(producer_stats)
+    with spool_lock:
+        spool_depth = spool_state['depth']
+        spool_oldest = spool_state['oldest']
+
+    status['mode'] = app_config['events']['producer']['mode']
+    status['queue_depth'] = depth
+    status['queue_capacity'] = app_config['events']['producer']['queue_size']
+    status['spool_depth'] = spool_depth
+    status['spool_age_sec'] = round(time.time() - spool_oldest, 3) if spool_oldest else 0
+    return status, 200
+
+def init_worker():
+    """Per-process startup: every worker owns its producer, spool and threads"""
     try:
-        producer = get_kafka_client()
+        connect_kafka()
         logger.info("Kafka producer initialized successfully at startup")
     except Exception as e:
         logger.error(f"Failed to initialize Kafka producer at startup: {str(e)}")
-    
-    app.run(host="0.0.0.0", port=8080)
+
+    start_spool_drainer()
+    start_publisher()
+    logger.info(f"Worker {os.getpid()} spooling to {spool_state['filename']}")
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    init_worker()
+    yield
+
+app = connexion.FlaskApp(__name__, specification_dir='', lifespan=lifespan)
+app.add_api("openapi.yaml", base_path="/receiver", **validation.api_options(app_config))
+
+# new endpoint that returns the health status of the service
+def get_check():
+    return NoContent, 200
+
+def get_ready():
+    """Ready only once this worker has a Kafka connection"""
+    if kafka_client is None:
+        return {"message": "Kafka not connected"}, 503
+    return NoContent, 200
+
+if __name__ == "__main__":
+    uvicorn.run("app:app",
+                host="0.0.0.0",
+                port=8080,
+                workers=app_config['serving']['workers'])
@@ -1,18 +1,31 @@
 import connexion
-from connexion import NoContent
-from sqlalchemy import create_engine, and_
+from connexion import NoContent, request
+from connexion.jsonifier import JSONEncoder
+from flask import Response as FlaskResponse
+from sqlalchemy import create_engine, and_, select, update, func
 from sqlalchemy.orm import sessionmaker
-from models import Base, RunningData, MusicData
-from db import get_db_session, create_tables
+from sqlalchemy.dialects import mysql, sqlite
+from models import Base, RunningData, MusicData, EventCounter, RunningRollupHourly, MusicRollupHourly
+from db import get_db_session, get_read_session, get_window_session, get_complete_read_session, create_tables, ReadSessionFactory, DB_ENGINE, READ_ENGINE, pool_metrics
+from apscheduler.schedulers.background import BackgroundScheduler
+from partitions import maintain_partitions
 import yaml
+import validation
 import logging
 import logging.config
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import os
 import json
-from threading import Thread
+from threading import Thread, Lock, Event
+import multiprocessing
+import signal
+import traceback
+from collections import OrderedDict, Counter
 from pykafka import KafkaClient
 from pykafka.common import OffsetType
+from event_codec import decode_event
+from dead_letter import publish_dead_letter
+from sqlalchemy.exc import OperationalError
 from dotenv import load_dotenv
 import uuid
 import time
@@ -45,129 +58,664 @@ logger.info("App Conf File: %s" % app_conf_file)
 logger.info("Log Conf File: %s" % log_conf_file)
 logger.info(f"Connecting to DB. Hostname:{app_config['datastore']['hostname']}, Port:{app_config['datastore']['port']}")
 
-def get_running_stats(start_timestamp, end_timestamp):
-    """ Gets running stats after the timestamp """
-    session = get_db_session()
-    
-    start_timestamp_datetime = datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    end_timestamp_datetime = datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    
-    readings = session.query(RunningData).filter(
-        and_(RunningData.date_created >= start_timestamp_datetime,
-             RunningData.date_created < end_timestamp_datetime)
-    )
-    
-    results_list = []
-    for reading in readings:
-        results_list.append(reading.to_dict())
-    
+def parse_window(start_timestamp, end_timestamp):
+    return (datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ"),
+            datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ"))
+
+def floor_hour(value):
+    return value.replace(minute=0, second=0, microsecond=0)
+
+def ceil_hour(value):
+    floored = floor_hour(value)
+    return floored if floored == value else floored + timedelta(hours=1)
+
+def window_statement(model, start_timestamp, end_timestamp, after_id, time_field='date_created'):
+    """ Keyset query for rows with time_field in [start, end) and an id after the cursor """
+    start_timestamp_datetime, end_timestamp_datetime = parse_window(start_timestamp, end_timestamp)
+    column = getattr(model, time_field)
+
+    return select(model).where(
+        and_(column >= start_timestamp_datetime,
+             column < end_timestamp_datetime,
+             model.id > after_id)
+    ).order_by(model.id)
+
+def wants_ndjson():
+    return "application/x-ndjson" in request.headers.get("Accept", "")
+
+def stream_ndjson(stmt):
+    """ Stream rows as NDJSON, reading them from the DB yield_per rows at a time """
+    def generate():
+        # Not the scoped session: the WSGI server may pull chunks from different threads
+        session = ReadSessionFactory()
+        try:
+            result = session.execute(stmt.execution_options(yield_per=app_config['query']['stream_chunk_size']))
+            for reading in result.scalars():
+                yield json.dumps(reading.to_dict(), cls=JSONEncoder) + "\n"
+        finally:
+            session.close()
+
+    return FlaskResponse(generate(), mimetype="application/x-ndjson")
+
+def read_page(stmt, limit, get_session=get_read_session):
+    """ Read one page of rows, returning it with the cursor for the next page """
+    session = get_session()
+    readings = session.execute(stmt.limit(limit)).scalars()
+    results_list = [reading.to_dict() for reading in readings]
     session.close()
-    
+
+    headers = {"Content-Type": "application/json"}
+    if len(results_list) == limit:
+        headers["X-Next-After-Id"] = str(results_list[-1]['id'])
+    return results_list, headers
+
+# Pages of closed windows never change: LRU of
+# (type, start, end, after_id, limit) -> (results_list, headers)
+window_cache = OrderedDict()
+window_cache_lock = Lock()
+cache_stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'rows': 0}
+
+# date_created of the batches being stored right now
+in_flight_batches = Counter()
+in_flight_lock = Lock()
+
+# In process mode, worker process i writes the date_created timestamp of
+# the batch it is storing to in_flight_slots[i] (0 when idle), so the HTTP
+# handlers in the main process can see it
+in_flight_slots = None
+worker_slot = None
+
+def window_is_closed(end_timestamp):
+    """ True once no row can still be added with a date_created before end_timestamp
+
+    Batches of this process are tracked exactly; closed_after_sec covers
+    the transactions of other Storage replicas. Replication lag is not
+    covered: pages to be cached are read from the primary.
+    """
+    end = datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
+    if end > datetime.now() - timedelta(seconds=app_config['cache']['closed_after_sec']):
+        return False
+    if in_flight_slots is not None:
+        if any(0 < started < end.timestamp() for started in in_flight_slots[:]):
+            return False
+    with in_flight_lock:
+        return all(date_created >= end for date_created in in_flight_batches)
+
+def cached_page(key):
+    with window_cache_lock:
+        page = window_cache.get(key)
+        if page is None:
+            cache_stats['misses'] += 1
+            return None
+        window_cache.move_to_end(key)
+        cache_stats['hits'] += 1
+        return page
+
+def page_size(page):
+    # an empty page still takes an entry
+    return max(len(page[0]), 1)
+
+def cache_page(key, page):
+    max_rows = app_config['cache']['max_rows']
+    if page_size(page) > max_rows:
+        return
+    with window_cache_lock:
+        if key in window_cache:
+            return
+        window_cache[key] = page
+        cache_stats['rows'] += page_size(page)
+        while cache_stats['rows'] > max_rows:
+            _, evicted = window_cache.popitem(last=False)
+            cache_stats['rows'] -= page_size(evicted)
+
+def clear_window_cache():
+    with window_cache_lock:
+        window_cache.clear()
+        cache_stats['rows'] = 0
+
+def read_window_page(event_type, stmt, start_timestamp, end_timestamp, limit, after_id, time_field):
+    """ read_page() through the cache when the window is closed
+
+    Only date_created windows ever close: a watch can sync events with
+    an old event_time at any moment.
+    """
+    if time_field != 'date_created' or not window_is_closed(end_timestamp):
+        with window_cache_lock:
+            cache_stats['bypassed'] += 1
+        return read_page(stmt, limit)
+
+    key = (event_type, start_timestamp, end_timestamp, after_id, limit)
+    page = cached_page(key)
+    if page is None:
+        # A lagging replica could still be missing rows of the window, and
+        # the page is cached for good, so it comes from the primary
+        page = read_page(stmt, limit, get_complete_read_session)
+        cache_page(key, page)
+    results_list, headers = page
+    return results_list, dict(headers)
+
+def get_running_stats(start_timestamp, end_timestamp, limit=1000, after_id=0, time_field='date_created'):
+    """ Gets a page of running stats after the timestamp """
+    stmt = window_statement(RunningData, start_timestamp, end_timestamp, after_id, time_field)
+    if wants_ndjson():
+        return stream_ndjson(stmt)
+
+    results_list, headers = read_window_page('running_stats', stmt, start_timestamp, end_timestamp, limit, after_id, time_field)
+
     if results_list:  
         logger.info("Query for Running stats after %s returns %d results" % 
                     (start_timestamp, len(results_list)))
     
-    return results_list, 200
+    return results_list, 200, headers
+
+def get_music_info(start_timestamp, end_timestamp, limit=1000, after_id=0, time_field='date_created'):
+    """ Gets a page of music info after the timestamp """
+    stmt = window_statement(MusicData, start_timestamp, end_timestamp, after_id, time_field)
+    if wants_ndjson():
+        return stream_ndjson(stmt)
+
+    results_list, headers = read_window_page('music_info', stmt, start_timestamp, end_timestamp, limit, after_id, time_field)
 
-def get_music_info(start_timestamp, end_timestamp):
-    """ Gets music info after the timestamp """
-    # logger.info("DEMO FOR ASSIGNMENT 3")
-    session = get_db_session()
-    
-    start_timestamp_datetime = datetime.strptime(start_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    end_timestamp_datetime = datetime.strptime(end_timestamp, "%Y-%m-%dT%H:%M:%SZ")
-    
-    readings = session.query(MusicData).filter(
-        and_(MusicData.date_created >= start_timestamp_datetime,
-             MusicData.date_created < end_timestamp_datetime)
-    )
-    
-    results_list = []
-    for reading in readings:
-        results_list.append(reading.to_dict())
-    
-    session.close()
-    
     if results_list:
         logger.info("Query for Music info after %s returns %d results" % 
                     (start_timestamp, len(results_list)))
     
-    return results_list, 200
+    return results_list, 200, headers
 
-def running_stats(body):
-    """ Receives running data """
-    session = get_db_session()
-    rd = RunningData(
-        user_id=body['user_id'],
-        duration=body['duration'],
-        distance=body['distance'],
-        timestamp=body['timestamp'],
-        trace_id=body.get('trace_id', str(uuid.uuid4()))
-    )
-    
-    session.add(rd)
-    session.commit()
-    trace_id = rd.trace_id
+# Aggregates kept in the hourly rollups, as name -> (function, event column).
+# Each rollup table has a column per name, plus count.
+RUNNING_MEASURES = {
+    'sum_duration': ('sum', 'duration'),
+    'max_distance': ('max', 'distance'),
+    'max_duration': ('max', 'duration'),
+}
+MUSIC_MEASURES = {
+    'sum_song_duration': ('sum', 'song_duration'),
+}
+
+def raw_aggregate(session, model, measures, start, end):
+    """ Aggregate the event rows created in [start, end) """
+    functions = {'sum': func.sum, 'max': func.max}
+    stmt = select(func.count().label('count'),
+                  *[func.coalesce(functions[fn](getattr(model, column)), 0).label(name)
+                    for name, (fn, column) in measures.items()]
+                  ).where(model.date_created >= start, model.date_created < end)
+    return session.execute(stmt).one()._mapping
+
+def rollup_aggregate(session, rollup, measures, start, end):
+    """ Aggregate the rollup rows for the hours in [start, end) """
+    functions = {'sum': func.sum, 'max': func.max}
+    stmt = select(func.coalesce(func.sum(rollup.count), 0).label('count'),
+                  *[func.coalesce(functions[fn](getattr(rollup, name)), 0).label(name)
+                    for name, (fn, _) in measures.items()]
+                  ).where(rollup.hour >= start, rollup.hour < end)
+    return session.execute(stmt).one()._mapping
+
+def read_aggregate(model, rollup, measures, start_timestamp, end_timestamp):
+    """ Aggregate a window from the rollups for its whole hours and the raw rows for the partial hours at either end
+
+    MySQL returns SUM() as a Decimal; every aggregated column is an integer
+    column, so the values are handed back as ints.
+    """
+    start, end = parse_window(start_timestamp, end_timestamp)
+    first_hour, last_hour = ceil_hour(start), floor_hour(end)
+
+    # Processing moves past the window once it has the aggregate, so it
+    # must not come from a replica that is still missing rows of it
+    session = get_window_session(end)
+    if first_hour < last_hour:
+        parts = [raw_aggregate(session, model, measures, start, first_hour),
+                 rollup_aggregate(session, rollup, measures, first_hour, last_hour),
+                 raw_aggregate(session, model, measures, last_hour, end)]
+    else:
+        parts = [raw_aggregate(session, model, measures, start, end)]
     session.close()
 
-    logger.info(f"Store event running_stats request with a trace id of {rd.trace_id}")
+    aggregate = {'count': sum(int(part['count']) for part in parts)}
+    for name, (fn, _) in measures.items():
+        combine = sum if fn == 'sum' else max
+        aggregate[name] = combine(int(part[name]) for part in parts)
+    return aggregate
+
+def read_series(rollup, start_timestamp, end_timestamp):
+    """ Rollup rows for the hours that start in [start, end) """
+    start, end = parse_window(start_timestamp, end_timestamp)
+    session = get_read_session()
+    rows = session.execute(
+        select(rollup).where(rollup.hour >= start, rollup.hour < end).order_by(rollup.hour)
+    ).scalars()
+    results_list = [row.to_dict() for row in rows]
+    session.close()
+    return results_list
 
+def get_running_aggregate(start_timestamp, end_timestamp):
+    """ Gets count, total duration and maxima of the running stats in the window """
+    aggregate = read_aggregate(RunningData, RunningRollupHourly, RUNNING_MEASURES,
+                               start_timestamp, end_timestamp)
+    logger.info(f"Running aggregate from {start_timestamp} to {end_timestamp}: {aggregate}")
+    return aggregate, 200
 
+def get_music_aggregate(start_timestamp, end_timestamp):
+    """ Gets count and total song duration of the music info in the window """
+    aggregate = read_aggregate(MusicData, MusicRollupHourly, MUSIC_MEASURES,
+                               start_timestamp, end_timestamp)
+    logger.info(f"Music aggregate from {start_timestamp} to {end_timestamp}: {aggregate}")
+    return aggregate, 200
+
+def get_running_series(start_timestamp, end_timestamp):
+    """ Gets the hourly running rollups in the window """
+    results_list = read_series(RunningRollupHourly, start_timestamp, end_timestamp)
+    logger.info(f"Running series from {start_timestamp} to {end_timestamp} returns {len(results_list)} hours")
+    return results_list, 200
+
+def get_music_series(start_timestamp, end_timestamp):
+    """ Gets the hourly music rollups in the window """
+    results_list = read_series(MusicRollupHourly, start_timestamp, end_timestamp)
+    logger.info(f"Music series from {start_timestamp} to {end_timestamp} returns {len(results_list)} hours")
+    return results_list, 200
+
+def running_stats(body):
+    """ Receives running data """
+    store_batch([{'type': 'running_stats', 'payload': body}])
     return NoContent, 201
 
 def music_info(body):
     """ Receives music data """
+    store_batch([{'type': 'music_info', 'payload': body}])
+    return NoContent, 201
+
+def parse_event_time(timestamp):
+    """ The event's own ISO 8601 timestamp as a naive UTC datetime, or None """
+    try:
+        event_time = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        return None
+    if event_time.tzinfo is not None:
+        event_time = event_time.astimezone(timezone.utc).replace(tzinfo=None)
+    # whole seconds, as DATETIME would round them
+    return event_time.replace(microsecond=0)
+
+def running_row(payload):
+    return {
+        'user_id': payload['user_id'],
+        'duration': payload['duration'],
+        'distance': payload['distance'],
+        'timestamp': payload['timestamp'],
+        'event_time': parse_event_time(payload['timestamp']),
+        'trace_id': payload.get('trace_id', str(uuid.uuid4())),
+    }
+
+def music_row(payload):
+    return {
+        'user_id': payload['user_id'],
+        'song_name': payload['song_name'],
+        'artist': payload['artist'],
+        'song_duration': payload['song_duration'],
+        'timestamp': payload['timestamp'],
+        'event_time': parse_event_time(payload['timestamp']),
+        'trace_id': payload.get('trace_id', str(uuid.uuid4())),
+    }
+
+def add_to_counters(session, counts):
+    """ Add stored event counts to event_counters in the caller's transaction """
+    # Always update in the same order so concurrent batches cannot deadlock
+    for event_type in sorted(counts):
+        if not counts[event_type]:
+            continue
+        result = session.execute(
+            update(EventCounter)
+            .where(EventCounter.event_type == event_type)
+            .values(num_events=EventCounter.num_events + counts[event_type])
+        )
+        if result.rowcount == 0:
+            session.add(EventCounter(event_type=event_type, num_events=counts[event_type]))
+
+# LRU of the trace_ids of recently stored events, so redelivered messages
+# are dropped without a round trip to the database
+recent_trace_ids = OrderedDict()
+recent_lock = Lock()
+
+def seen_recently(trace_id):
+    with recent_lock:
+        if trace_id in recent_trace_ids:
+            recent_trace_ids.move_to_end(trace_id)
+            return True
+    return False
+
+def remember_trace_ids(trace_ids):
+    capacity = app_config['dedupe']['cache_size']
+    with recent_lock:
+        for trace_id in trace_ids:
+            recent_trace_ids[trace_id] = None
+            recent_trace_ids.move_to_end(trace_id)
+        while len(recent_trace_ids) > capacity:
+            recent_trace_ids.popitem(last=False)
+
+def new_rows(session, model, rows):
+    """ Drop rows whose trace_id is repeated in the batch, seen recently or already stored """
+    unique = {}
+    for row in rows:
+        if row['trace_id'] not in unique and not seen_recently(row['trace_id']):
+            unique[row['trace_id']] = row
+    if unique:
+        stored = session.scalars(select(model.trace_id).where(model.trace_id.in_(list(unique))))
+        for trace_id in stored:
+            del unique[trace_id]
+    return list(unique.values())
+
+def insert_new(session, model, rows, date_created):
+    """ Insert rows created at date_created and return the ones actually inserted
+
+    Only a unique key conflict is skipped, the backstop for a trace_id
+    another worker stored after new_rows() checked; out-of-range or
+    malformed values still raise, so the event is dead-lettered rather
+    than stored clamped. The inserted rows are then read back: the
+    transaction reads from the snapshot new_rows() started (REPEATABLE
+    READ), so a conflicting row committed by another worker since is not
+    visible and only this insert's rows come back.
+    """
+    if session.bind.dialect.name == 'mysql':
+        stmt = mysql.insert(model).on_duplicate_key_update(id=model.id)
+    else:
+        stmt = sqlite.insert(model).on_conflict_do_nothing()
+    session.execute(stmt, [{**row, 'date_created': date_created} for row in rows])
+
+    inserted = set(session.scalars(select(model.trace_id).where(
+        model.trace_id.in_([row['trace_id'] for row in rows]),
+        model.date_created == date_created)))
+    return [row for row in rows if row['trace_id'] in inserted]
+
+def rollup_row(hour, rows, measures):
+    """ The rollup contribution of rows that were all created in hour """
+    row = {'hour': hour, 'count': len(rows)}
+    for name, (fn, column) in measures.items():
+        combine = sum if fn == 'sum' else max
+        row[name] = combine(r[column] for r in rows)
+    return row
+
+def upsert_rollup(session, rollup, measures, row):
+    """ Add row to the rollup for its hour in the caller's transaction """
+    if session.bind.dialect.name == 'mysql':
+        stmt = mysql.insert(rollup).values(row)
+        new, greatest = stmt.inserted, func.greatest
+    else:
+        stmt = sqlite.insert(rollup).values(row)
+        new, greatest = stmt.excluded, func.max
+
+    changes = {'count': rollup.count + new.count}
+    for name, (fn, _) in measures.items():
+        current = getattr(rollup, name)
+        changes[name] = current + getattr(new, name) if fn == 'sum' else greatest(current, getattr(new, name))
+
+    if session.bind.dialect.name == 'mysql':
+        stmt = stmt.on_duplicate_key_update(**changes)
+    else:
+        stmt = stmt.on_conflict_do_update(index_elements=['hour'], set_=changes)
+    session.execute(stmt)
+
+def store_batch(events):
+    """ Write a batch of events with one bulk insert per type in a single transaction
+
+    Events whose trace_id is already stored are skipped, so a batch can be
+    redelivered or replayed without double counting.
+    """
+    running_rows = [running_row(e['payload']) for e in events if e['type'] == 'running_stats']
+    music_rows = [music_row(e['payload']) for e in events if e['type'] == 'music_info']
+
+    # date_created is set here rather than by the database so the batch's
+    # rollup hour is known; whole seconds, as DATETIME would round them
+    date_created = datetime.now().replace(microsecond=0)
+    hour = floor_hour(date_created)
+
+    with in_flight_lock:
+        in_flight_batches[date_created] += 1
+    if worker_slot is not None:
+        in_flight_slots[worker_slot] = date_created.timestamp()
+
     session = get_db_session()
-    md = MusicData(
-        user_id=body['user_id'],
-        song_name=body['song_name'],
-        artist=body['artist'],
-        song_duration=body['song_duration'],
-        timestamp=body['timestamp'],
-        trace_id=body.get('trace_id', str(uuid.uuid4()))
-    )
-    
-    session.add(md)
-    session.commit()
-    trace_id = md.trace_id
-    session.close()
+    try:
+        new_running = new_rows(session, RunningData, running_rows)
+        new_music = new_rows(session, MusicData, music_rows)
+        # counters and rollups follow what was inserted, not what new_rows() expected
+        if new_running:
+            new_running = insert_new(session, RunningData, new_running, date_created)
+        if new_running:
+            upsert_rollup(session, RunningRollupHourly, RUNNING_MEASURES, rollup_row(hour, new_running, RUNNING_MEASURES))
+        if new_music:
+            new_music = insert_new(session, MusicData, new_music, date_created)
+        if new_music:
+            upsert_rollup(session, MusicRollupHourly, MUSIC_MEASURES, rollup_row(hour, new_music, MUSIC_MEASURES))
+        add_to_counters(session, {'running_stats': len(new_running), 'music_info': len(new_music)})
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+        with in_flight_lock:
+            in_flight_batches[date_created] -= 1
+            if not in_flight_batches[date_created]:
+                del in_flight_batches[date_created]
+        if worker_slot is not None:
+            in_flight_slots[worker_slot] = 0
 
-    logger.info(f"Store event music_info request with a trace id of {md.trace_id}")
+    remember_trace_ids(row['trace_id'] for row in running_rows + music_rows)
 
-    return NoContent, 201
+    duplicates = len(running_rows) + len(music_rows) - len(new_running) - len(new_music)
+    logger.info(f"Stored batch of {len(new_running)} running_stats and {len(new_music)} music_info events, "
+                f"skipped {duplicates} duplicates")
 
-def process_messages():
-    """ Process event messages """
-    hostname = "%s:%d" % (app_config['events']['hostname'], app_config['events']['port'])
-    client = KafkaClient(hosts=hostname)
-    topic = client.topics[str.encode(app_config['events']['topic'])]
+def decode_batch(messages):
+    """ Decode Kafka messages into (message, event) pairs and (message, error) failures """
+    decoded, failed = [], []
+    for message in messages:
+        try:
+            decoded.append((message, decode_event(message.value)))
+        except Exception as e:
+            logger.error(f"Undecodable message at partition {message.partition_id} offset {message.offset}: {str(e)}")
+            failed.append((message, e))
+    return decoded, failed
+
+def isolate_failures(decoded):
+    """ Store events one at a time after their batch failed
+
+    Returns the events still to store, which is non-empty only if the
+    database became unavailable, and the (message, error) pairs of the
+    events that failed on their own.
+    """
+    failed = []
+    for i, (message, event) in enumerate(decoded):
+        try:
+            store_batch([event])
+        except OperationalError:
+            return decoded[i:], failed
+        except Exception as e:
+            logger.error(f"Event at partition {message.partition_id} offset {message.offset} cannot be stored: {str(e)}")
+            failed.append((message, e))
+    return [], failed
 
-    consumer = topic.get_simple_consumer(consumer_group=b'event_group', reset_offset_on_start=False, auto_offset_reset=OffsetType.LATEST)
+def flush_batch(consumer, dead_letters, messages, stop):
+    """ Store a batch, dead-letter the messages that cannot be stored, then commit offsets once
 
-    while True:
+    A database that is unavailable (OperationalError) is retried with
+    backoff. Any other failure is blamed on the events: the batch is
+    stored one event at a time and those that still fail go to the
+    dead-letter topic, so one bad event never holds up its partition.
+    If stop is set while the database is failing, the batch is left
+    uncommitted and is redelivered to whichever consumer takes over.
+    """
+    decoded, failed = decode_batch(messages)
+    retry_delay = 1
+    while decoded:
         try:
-            for msg in consumer:
-                msg_str = msg.value.decode('utf-8')
-                msg = json.loads(msg_str)
-                logger.info(f"Consumed message: {msg}")
+            store_batch([event for _, event in decoded])
+            break
+        except OperationalError as e:
+            if stop.is_set():
+                logger.error(f"Failed to store batch of {len(decoded)} events while stopping, leaving it uncommitted: {str(e)}")
+                return
+            logger.error(f"Failed to store batch of {len(decoded)} events, retrying in {retry_delay}s: {str(e)}")
+            stop.wait(retry_delay)
+            retry_delay = min(retry_delay * 2, 30)
+        except Exception as e:
+            logger.error(f"Batch of {len(decoded)} events rejected, storing them one by one: {str(e)}")
+            decoded, poison = isolate_failures(decoded)
+            failed += poison
 
-                payload = msg['payload']
+    for message, error in failed:
+        publish_dead_letter(dead_letters, message, error, "storage")
+    if failed:
+        logger.info(f"Sent {len(failed)} messages to {app_config['events']['dead_letter_topic']}")
 
-                if msg['type'] == 'running_stats':
-                    running_stats(payload)
-                elif msg['type'] == 'music_info':
-                    music_info(payload)
+    consumer.commit_offsets()
 
-                consumer.commit_offsets()
+def process_messages(stop, worker_id=0, topic_name=None, consumer_group=b'event_group'):
+    """ Process event messages in batches of up to batch_size or linger_ms until stop is set
+
+    Reads the events topic unless topic_name is given.
+    """
+    hostname = "%s:%d" % (app_config['events']['hostname'], app_config['events']['port'])
+    topic_name = topic_name or app_config['events']['topic']
+    batch_size = app_config['consumer']['batch_size']
+    linger_ms = app_config['consumer']['linger_ms']
+
+    while not stop.is_set():
+        consumer = None
+        dead_letters = None
+        try:
+            client = KafkaClient(hosts=hostname)
+            topic = client.topics[str.encode(topic_name)]
+            dead_letters = client.topics[str.encode(app_config['events']['dead_letter_topic'])].get_sync_producer()
+
+            # Balanced group: partitions are shared between all workers of all
+            # Storage replicas. consume() gives up after linger_ms so a partial
+            # batch still gets flushed, and stop is noticed.
+            consumer = topic.get_balanced_consumer(consumer_group=consumer_group,
+                                                   managed=True,
+                                                   auto_commit_enable=False,
+                                                   reset_offset_on_start=False,
+                                                   auto_offset_reset=OffsetType.LATEST,
+                                                   consumer_timeout_ms=linger_ms)
+            logger.info(f"Consumer worker {worker_id} joined {consumer_group.decode()} on {topic_name}")
+
+            batch = []
+            deadline = None
+            while not stop.is_set():
+                message = consumer.consume(block=True)
+                if message is not None:
+                    batch.append(message)
+                    if deadline is None:
+                        deadline = time.time() + linger_ms / 1000
+
+                if batch and (len(batch) >= batch_size or time.time() >= deadline):
+                    flush_batch(consumer, dead_letters, batch, stop)
+                    batch = []
+                    deadline = None
+
+            if batch:
+                logger.info(f"Consumer worker {worker_id} flushing {len(batch)} messages before stopping")
+                flush_batch(consumer, dead_letters, batch, stop)
         except Exception as e:
-            logger.error(f"Error processing message: {str(e)}")
+            # Uncommitted messages are fetched again by the next consumer
+            logger.error(f"Consumer worker {worker_id} error processing messages: {str(e)}")
+            stop.wait(5)
+        finally:
+            if consumer is not None:
+                consumer.stop()
+            if dead_letters is not None:
+                dead_letters.stop()
+
+    logger.info(f"Consumer worker {worker_id} stopped")
 
+def run_worker_process(stop, worker_id, *topic):
+    """ Entry point of a consumer worker process """
+    global worker_slot
+    # Shutdown is driven by the main process through stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # Pooled connections inherited through fork belong to the parent
+    DB_ENGINE.dispose(close=False)
+    READ_ENGINE.dispose(close=False)
+    worker_slot = worker_id
+    process_messages(stop, worker_id, *topic)
+
+def start_workers():
+    """ Start consumer.workers consumers as threads or processes (consumer.mode)
+
+    Each worker owns its own balanced consumer, so Kafka hands it its own
+    partitions, and its own DB session. One more worker consumes the
+    replay topic that replay_dead_letters.py sends Storage's dead letters
+    back to. Returns the stop event and workers.
+    """
+    global in_flight_slots
+    count = app_config['consumer']['workers']
+    topics = [()] * count + [(app_config['events']['replay_topics']['storage'], b'event_replay_group')]
+
+    if app_config['consumer']['mode'] == 'process':
+        context = multiprocessing.get_context("fork")
+        stop = context.Event()
+        in_flight_slots = context.Array('d', len(topics))
+        workers = [context.Process(target=run_worker_process, args=(stop, i, *topic),
+                                   name=f"consumer-{i}", daemon=True)
+                   for i, topic in enumerate(topics)]
+    else:
+        stop = Event()
+        workers = [Thread(target=process_messages, args=(stop, i, *topic),
+                          name=f"consumer-{i}", daemon=True)
+                   for i, topic in enumerate(topics)]
+
+    for worker in workers:
+        worker.start()
+    logger.info(f"Started {count} consumer workers ({app_config['consumer']['mode']} mode)")
+    return stop, workers
+
+def stop_workers(stop, workers):
+    """ Ask the workers to flush their batches and wait for them """
+    logger.info("Stopping consumer workers")
+    stop.set()
+    deadline = time.time() + app_config['consumer']['shutdown_timeout_sec']
+    for worker in workers:
+        worker.join(max(deadline - time.time(), 0))
+        if worker.is_alive():
+            logger.error(f"Consumer worker {worker.name} did not stop in time")
+
+def run_partition_maintenance():
+    """ Add upcoming monthly partitions and drop the ones past retention """
+    try:
+        db_conn = DB_ENGINE.raw_connection()
+        try:
+            changes = maintain_partitions(db_conn, app_config['datastore']['db'], app_config['partitioning'])
+            for change in changes:
+                logger.info(change)
+            if changes:
+                # Dropped partitions invalidate cached pages of their windows
+                clear_window_cache()
+        finally:
+            db_conn.close()
+    except Exception as e:
+        logger.error(f"Partition maintenance failed: {str(e)}")
+
+def init_scheduler():
+    if not app_config['partitioning']['enabled']:
+        return
+    sched = BackgroundScheduler(daemon=True)
+    sched.add_job(run_partition_maintenance,
+                  'interval',
+                  hours=app_config['partitioning']['check_interval_hours'])
+    sched.start()
+
+def get_metrics():
+    """ Cache and connection pool counters of the Storage service """
+    with window_cache_lock:
+        cache = {**cache_stats, 'entries': len(window_cache)}
+    return {"cache": cache, "pools": pool_metrics()}, 200
 
 def get_event_stats():
-    session = get_db_session()
+    """ Event totals from event_counters, without scanning the event tables """
+    session = get_read_session()
     
-    num_running = session.query(RunningData).count()
-    num_music = session.query(MusicData).count()
+    counters = dict(session.execute(select(EventCounter.event_type, EventCounter.num_events)).all())
+    num_running = counters.get('running_stats', 0)
+    num_music = counters.get('music_info', 0)
     
     session.close()
     
@@ -180,7 +728,7 @@ def get_event_stats():
     return stats, 200
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yaml", base_path="/storage", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yaml", base_path="/storage", **validation.api_options(app_config))
 
 if __name__ == "__main__":
     try:
@@ -191,7 +739,11 @@ if __name__ == "__main__":
         logger.error(f"Error creating tables: {str(e)}")
         logger.error(traceback.format_exc())
     
-    t1 = Thread(target=process_messages)
-    t1.setDaemon = True
-    t1.start()
+    # Workers first: processes are forked before any other thread starts
+    stop, workers = start_workers()
+    init_scheduler()
+
     app.run(host="0.0.0.0", port=8090)
+
+    # app.run() returns once the server has shut down on SIGTERM/SIGINT
+    stop_workers(stop, workers)
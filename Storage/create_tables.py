@@ -10,6 +10,7 @@ c.execute('''
         duration INTEGER NOT NULL,
         distance INTEGER NOT NULL,
         timestamp VARCHAR(100) NOT NULL,
+        event_time DATETIME,
         trace_id VARCHAR(100) NOT NULL,
         date_created VARCHAR(100) NOT NULL
     )
@@ -22,11 +23,48 @@ c.execute('''
         artist VARCHAR(250) NOT NULL,
         song_duration INTEGER NOT NULL,
         timestamp VARCHAR(100) NOT NULL,
+        event_time DATETIME,
         trace_id VARCHAR(100) NOT NULL,
         date_created VARCHAR(100) NOT NULL
     )
 ''')
-
+c.execute('''
+    CREATE TABLE running_rollup_hourly (
+        hour DATETIME PRIMARY KEY,
+        count BIGINT NOT NULL,
+        sum_duration BIGINT NOT NULL,
+        max_distance INTEGER NOT NULL,
+        max_duration INTEGER NOT NULL
+    )
+''')
+c.execute('''
+    CREATE TABLE music_rollup_hourly (
+        hour DATETIME PRIMARY KEY,
+        count BIGINT NOT NULL,
+        sum_song_duration BIGINT NOT NULL
+    )
+''')
+c.execute('''
+    CREATE TABLE event_counters (
+        event_type VARCHAR(50) PRIMARY KEY,
+        num_events BIGINT NOT NULL DEFAULT 0
+    )
+''')
+c.execute('''
+    INSERT INTO event_counters (event_type, num_events)
+    VALUES ('running_stats', 0), ('music_info', 0)
+''')
+for index_sql in [
+    'CREATE INDEX ix_running_data_date_created ON running_data (date_created)',
+    'CREATE INDEX ix_running_data_user_id_date_created ON running_data (user_id, date_created)',
+    'CREATE UNIQUE INDEX uq_running_data_trace_id ON running_data (trace_id)',
+    'CREATE INDEX ix_running_data_event_time ON running_data (event_time)',
+    'CREATE INDEX ix_music_data_date_created ON music_data (date_created)',
+    'CREATE INDEX ix_music_data_user_id_date_created ON music_data (user_id, date_created)',
+    'CREATE UNIQUE INDEX uq_music_data_trace_id ON music_data (trace_id)',
+    'CREATE INDEX ix_music_data_event_time ON music_data (event_time)',
+]:
+    c.execute(index_sql)
 
 conn.commit()
 conn.close()
\ No newline at end of file
@@ -5,6 +5,168 @@ import time
 import os
 from dotenv import load_dotenv
 import sys
+from datetime import datetime
+from partitions import maintain_partitions
+
+# Secondary indexes every event table must have, as (name, kind, columns)
+EVENT_TABLE_INDEXES = {
+    'running_data': [
+        ('ix_running_data_date_created', 'INDEX', 'date_created'),
+        ('ix_running_data_user_id_date_created', 'INDEX', 'user_id, date_created'),
+        ('uq_running_data_trace_id', 'UNIQUE INDEX', 'trace_id'),
+        ('ix_running_data_event_time', 'INDEX', 'event_time'),
+    ],
+    'music_data': [
+        ('ix_music_data_date_created', 'INDEX', 'date_created'),
+        ('ix_music_data_user_id_date_created', 'INDEX', 'user_id, date_created'),
+        ('uq_music_data_trace_id', 'UNIQUE INDEX', 'trace_id'),
+        ('ix_music_data_event_time', 'INDEX', 'event_time'),
+    ],
+}
+
+# Indexes replaced by the ones above
+OBSOLETE_INDEXES = {
+    'running_data': ['ix_running_data_trace_id'],
+    'music_data': ['ix_music_data_trace_id'],
+}
+
+# event_counters row for each event table
+COUNTED_TABLES = {'running_stats': 'running_data', 'music_info': 'music_data'}
+TABLE_EVENT_TYPES = {table: event_type for event_type, table in COUNTED_TABLES.items()}
+
+def seed_counters(db_cursor):
+    """Create the event_counters rows that are missing from the current table sizes"""
+    db_cursor.execute("SELECT event_type FROM event_counters")
+    counted = {row[0] for row in db_cursor.fetchall()}
+    for event_type, table in COUNTED_TABLES.items():
+        if event_type in counted:
+            continue
+        print(f"Seeding event_counters for {event_type} from {table}")
+        db_cursor.execute(
+            f"INSERT INTO event_counters (event_type, num_events) SELECT %s, COUNT(*) FROM {table}",
+            (event_type,))
+
+# Rollup table for each event table, with the SELECT list that fills each column
+ROLLUP_TABLES = {
+    'running_rollup_hourly': ('running_data', {
+        'count': "COUNT(*)",
+        'sum_duration': "SUM(duration)",
+        'max_distance': "MAX(distance)",
+        'max_duration': "MAX(duration)",
+    }),
+    'music_rollup_hourly': ('music_data', {
+        'count': "COUNT(*)",
+        'sum_song_duration': "SUM(song_duration)",
+    }),
+}
+
+# How long a replica waits for another one to finish the backfill
+BACKFILL_LOCK_TIMEOUT_SEC = 600
+
+def backfill_rollups(db_conn, db_cursor):
+    """Build the rollups of the events stored before rollups existed
+
+    The first run records a cutover for each rollup table: the start of
+    the current hour. Storage keeps the rollups up to date for the hours
+    from the cutover on, so only the hours before it are backfilled, and
+    they are recomputed from the events rather than added to, so a retried
+    backfill or one that overlaps live ingest cannot count an event twice.
+    The backfill runs under a named lock so concurrent replicas wait for
+    the first one instead of backfilling too.
+    """
+    db_cursor.execute("SELECT GET_LOCK('rollup_backfill', %s)", (BACKFILL_LOCK_TIMEOUT_SEC,))
+    if db_cursor.fetchone()[0] != 1:
+        print("Timed out waiting for another rollup backfill, skipping it")
+        return
+    try:
+        for rollup, (table, aggregates) in ROLLUP_TABLES.items():
+            db_cursor.execute("SELECT cutover, done FROM rollup_backfill WHERE rollup_table = %s", (rollup,))
+            row = db_cursor.fetchone()
+            if row is None:
+                # Storage sets date_created from its own clock, so the cutover does too
+                cutover = datetime.now().replace(minute=0, second=0, microsecond=0)
+                db_cursor.execute("INSERT INTO rollup_backfill (rollup_table, cutover) VALUES (%s, %s)",
+                                  (rollup, cutover))
+                db_conn.commit()
+            elif row[1]:
+                continue
+            else:
+                cutover = row[0]
+
+            hour = "DATE_FORMAT(date_created, '%%Y-%%m-%%d %%H:00:00')"
+            columns = ", ".join(aggregates)
+            selected = ", ".join(f"{expression} AS {column}" for column, expression in aggregates.items())
+            updates = ", ".join(f"{column} = backfill.{column}" for column in aggregates)
+            db_cursor.execute(
+                f"INSERT INTO {rollup} (hour, {columns}) "
+                f"SELECT * FROM (SELECT {hour} AS hour, {selected} FROM {table} "
+                f"WHERE date_created < %s GROUP BY {hour}) AS backfill "
+                f"ON DUPLICATE KEY UPDATE {updates}", (cutover,))
+            db_cursor.execute("UPDATE rollup_backfill SET done = TRUE WHERE rollup_table = %s", (rollup,))
+            db_conn.commit()
+            print(f"Backfilled the hours before {cutover} into {rollup}")
+    finally:
+        db_cursor.execute("SELECT RELEASE_LOCK('rollup_backfill')")
+        db_cursor.fetchone()
+
+def migrate_tables(db_cursor, db_name):
+    """Bring tables created by older versions up to date
+
+    Tables from before the indexes existed stored date_created as VARCHAR
+    and had no secondary indexes. Each table is fixed with a single ALTER
+    so it is only rebuilt once.
+
+    event_time is added and backfilled by parsing timestamp in SQL. Only
+    the UTC "...Z" form is backfilled; rows with other offsets keep a
+    NULL event_time.
+
+    Before trace_id is made unique, duplicate events are deleted (keeping
+    the first copy) and the table's event_counters row is dropped so
+    seed_counters() recounts it.
+    """
+    for table, indexes in EVENT_TABLE_INDEXES.items():
+        db_cursor.execute(
+            "SELECT DISTINCT index_name FROM information_schema.statistics "
+            "WHERE table_schema = %s AND table_name = %s", (db_name, table))
+        existing = {row[0] for row in db_cursor.fetchall()}
+
+        db_cursor.execute(
+            "SELECT column_name, data_type FROM information_schema.columns "
+            "WHERE table_schema = %s AND table_name = %s", (db_name, table))
+        columns = {name.lower(): data_type.lower() for name, data_type in db_cursor.fetchall()}
+
+        changes = []
+        if columns.get('date_created', 'datetime') != 'datetime':
+            changes.append("MODIFY COLUMN date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP")
+        add_event_time = 'event_time' not in columns
+        if add_event_time:
+            changes.append("ADD COLUMN event_time DATETIME NULL AFTER timestamp")
+        changes += [f"DROP INDEX {name}" for name in OBSOLETE_INDEXES[table] if name in existing]
+        changes += [f"ADD {kind} {name} ({columns})" for name, kind, columns in indexes if name not in existing]
+
+        if any(kind == 'UNIQUE INDEX' and name not in existing for name, kind, _ in indexes):
+            # One GROUP BY pass picks the row kept per trace_id; a self-join on
+            # trace_id would be quadratic, as there is no index on it yet
+            db_cursor.execute(
+                f"DELETE dup FROM {table} dup "
+                f"LEFT JOIN (SELECT MIN(id) AS id FROM {table} GROUP BY trace_id) kept "
+                f"ON dup.id = kept.id WHERE kept.id IS NULL")
+            if db_cursor.rowcount:
+                print(f"Deleted {db_cursor.rowcount} duplicate events from {table}")
+                db_cursor.execute("DELETE FROM event_counters WHERE event_type = %s",
+                                  (TABLE_EVENT_TYPES[table],))
+
+        if not changes:
+            continue
+        migration_sql = f"ALTER TABLE {table} " + ", ".join(changes)
+        print(f"Migrating {table}: {migration_sql}")
+        db_cursor.execute(migration_sql)
+
+        if add_event_time:
+            db_cursor.execute(
+                f"UPDATE {table} SET event_time = STR_TO_DATE(LEFT(timestamp, 19), '%Y-%m-%dT%H:%i:%s') "
+                f"WHERE event_time IS NULL AND timestamp LIKE '____-__-__T__:__:__%Z'")
+            print(f"Backfilled event_time of {db_cursor.rowcount} rows in {table}")
 
 def create_tables_mysql(is_docker=False):
     # Load .env file
@@ -65,9 +227,14 @@ def create_tables_mysql(is_docker=False):
                 duration INTEGER NOT NULL,
                 distance INTEGER NOT NULL,
                 timestamp VARCHAR(100) NOT NULL,
+                event_time DATETIME NULL,
                 trace_id VARCHAR(100) NOT NULL,
-                date_created VARCHAR(100) NOT NULL,
-                PRIMARY KEY (id)
+                date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id),
+                INDEX ix_running_data_date_created (date_created),
+                INDEX ix_running_data_user_id_date_created (user_id, date_created),
+                UNIQUE INDEX uq_running_data_trace_id (trace_id),
+                INDEX ix_running_data_event_time (event_time)
             )''',
             '''CREATE TABLE IF NOT EXISTS music_data (
                 id INT NOT NULL AUTO_INCREMENT,
@@ -76,9 +243,39 @@ def create_tables_mysql(is_docker=False):
                 artist VARCHAR(250) NOT NULL,
                 song_duration INTEGER NOT NULL,
                 timestamp VARCHAR(100) NOT NULL,
+                event_time DATETIME NULL,
                 trace_id VARCHAR(100) NOT NULL,
-                date_created VARCHAR(100) NOT NULL,
-                PRIMARY KEY (id)
+                date_created DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (id),
+                INDEX ix_music_data_date_created (date_created),
+                INDEX ix_music_data_user_id_date_created (user_id, date_created),
+                UNIQUE INDEX uq_music_data_trace_id (trace_id),
+                INDEX ix_music_data_event_time (event_time)
+            )''',
+            '''CREATE TABLE IF NOT EXISTS running_rollup_hourly (
+                hour DATETIME NOT NULL,
+                count BIGINT NOT NULL,
+                sum_duration BIGINT NOT NULL,
+                max_distance INTEGER NOT NULL,
+                max_duration INTEGER NOT NULL,
+                PRIMARY KEY (hour)
+            )''',
+            '''CREATE TABLE IF NOT EXISTS music_rollup_hourly (
+                hour DATETIME NOT NULL,
+                count BIGINT NOT NULL,
+                sum_song_duration BIGINT NOT NULL,
+                PRIMARY KEY (hour)
+            )''',
+            '''CREATE TABLE IF NOT EXISTS rollup_backfill (
+                rollup_table VARCHAR(64) NOT NULL,
+                cutover DATETIME NOT NULL,
+                done BOOLEAN NOT NULL DEFAULT FALSE,
+                PRIMARY KEY (rollup_table)
+            )''',
+            '''CREATE TABLE IF NOT EXISTS event_counters (
+                event_type VARCHAR(50) NOT NULL,
+                num_events BIGINT NOT NULL DEFAULT 0,
+                PRIMARY KEY (event_type)
             )'''
         ]:
             try:
@@ -90,6 +287,17 @@ def create_tables_mysql(is_docker=False):
         
         db_conn.commit()
         print("Tables created successfully.")
+
+        migrate_tables(db_cursor, app_config['datastore']['db'])
+        seed_counters(db_cursor)
+        db_conn.commit()
+        backfill_rollups(db_conn, db_cursor)
+
+        # Partitioning narrows the trace_id unique index to (trace_id, date_created),
+        # leaving new_rows() in Storage as the only cross-second duplicate check
+        for change in maintain_partitions(db_conn, app_config['datastore']['db'],
+                                          app_config.get('partitioning', {})):
+            print(change)
         
         # Check if tables were actually created
         db_cursor.execute("SHOW TABLES")
@@ -1,9 +1,13 @@
 import sys
 import yaml
-from models import Base
-from sqlalchemy import create_engine
+import time
+import threading
+from models import Base, EventCounter, EVENT_MODELS
+from sqlalchemy import create_engine, func, select, exc
 from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.pool import QueuePool
 import os
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 
 # Load .env file
@@ -15,20 +19,93 @@ with open('app_conf.yml', 'r') as f:
 app_config['datastore']['password'] = os.getenv('MYSQL_ROOT_PASSWORD', app_config['datastore']['password'])
 app_config['datastore']['port'] = int(os.getenv('MYSQL_PORT', app_config['datastore']['port']))
 
-DB_ENGINE = create_engine(
-    f"mysql+pymysql://{app_config['datastore']['user']}:{app_config['datastore']['password']}@{app_config['datastore']['hostname']}:{app_config['datastore']['port']}/{app_config['datastore']['db']}",
-    pool_size=5,
-    max_overflow=10,
-    pool_timeout=30,
-    pool_recycle=1800
-)
+# Read replica, when there is one; reads go to the primary otherwise
+app_config['datastore']['read_hostname'] = os.getenv('MYSQL_READ_HOST', app_config['datastore'].get('read_hostname')) \
+    or app_config['datastore']['hostname']
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool that records checkouts and how long they waited for a connection """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = {"checkouts": 0, "timeouts": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0}
+        self.stats_lock = threading.Lock()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self.stats_lock:
+                self.stats["timeouts"] += 1
+            raise
+        finally:
+            waited_ms = (time.perf_counter() - started) * 1000
+            with self.stats_lock:
+                self.stats["checkouts"] += 1
+                self.stats["wait_ms_total"] += waited_ms
+                self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], waited_ms)
+
+def make_engine(hostname, pool):
+    return create_engine(
+        f"mysql+pymysql://{app_config['datastore']['user']}:{app_config['datastore']['password']}@{hostname}:{app_config['datastore']['port']}/{app_config['datastore']['db']}",
+        poolclass=TimedQueuePool,
+        pool_size=pool['pool_size'],
+        max_overflow=pool['max_overflow'],
+        pool_timeout=pool['pool_timeout'],
+        pool_recycle=1800,
+        # store_batch() relies on reads within a transaction coming from one snapshot
+        isolation_level="REPEATABLE READ"
+    )
+
+# Ingest and HTTP reads get their own pools so neither can starve the other
+DB_ENGINE = make_engine(app_config['datastore']['hostname'], app_config['datastore']['pools']['write'])
+READ_ENGINE = make_engine(app_config['datastore']['read_hostname'], app_config['datastore']['pools']['read'])
 
 SessionFactory = sessionmaker(bind=DB_ENGINE)
 Session = scoped_session(SessionFactory)
+ReadSessionFactory = sessionmaker(bind=READ_ENGINE)
+ReadSession = scoped_session(ReadSessionFactory)
 
 def get_db_session():
+    """ Session on the primary, for the consumer and anything that writes """
     return Session()
 
+def get_read_session():
+    """ Session on the read pool (the replica, if configured) for HTTP reads """
+    return ReadSession()
+
+def has_replica():
+    return app_config['datastore']['read_hostname'] != app_config['datastore']['hostname']
+
+def get_complete_read_session():
+    """ Read session that sees every committed row: the primary if reads otherwise go to a replica """
+    return get_db_session() if has_replica() else get_read_session()
+
+def get_window_session(end):
+    """ Session for reading rows created before end
+
+    The replica can be up to datastore.replica_lag_sec behind the primary,
+    so windows that end more recently than that are read from the primary;
+    older ones, and every window when there is no replica, from the read pool.
+    """
+    lag = timedelta(seconds=app_config['datastore']['replica_lag_sec'])
+    if end > datetime.now() - lag:
+        return get_complete_read_session()
+    return get_read_session()
+
+def pool_metrics():
+    """ Checkout counters and current usage of both pools """
+    metrics = {}
+    for name, engine in (("write", DB_ENGINE), ("read", READ_ENGINE)):
+        pool = engine.pool
+        with pool.stats_lock:
+            stats = dict(pool.stats)
+        stats["wait_ms_avg"] = stats["wait_ms_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        stats.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+        metrics[name] = stats
+    return metrics
+
 def create_tables():
     Base.metadata.create_all(DB_ENGINE)
     print("Tables created successfully.")
@@ -37,7 +114,36 @@ def drop_tables():
     Base.metadata.drop_all(DB_ENGINE)
     print("Tables dropped successfully.")
 
+def reconcile_counters():
+    """ Rebuild event_counters from the event tables
+
+    The counter rows are locked before counting, so batches stored while
+    this runs wait and are added on top of the recounted totals.
+    """
+    session = get_db_session()
+    try:
+        counters = {c.event_type: c for c in session.scalars(select(EventCounter).with_for_update())}
+        for event_type, model in EVENT_MODELS.items():
+            total = session.scalar(select(func.count()).select_from(model))
+            counter = counters.get(event_type)
+            if counter is None:
+                session.add(EventCounter(event_type=event_type, num_events=total))
+                print(f"{event_type}: set to {total}")
+            else:
+                print(f"{event_type}: {counter.num_events} -> {total}")
+                counter.num_events = total
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+    print("Counters reconciled.")
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "reconcile":
+        reconcile_counters()
+        sys.exit(0)
     if len(sys.argv) > 1 and sys.argv[1] == "drop":
         drop_tables()
     create_tables()
\ No newline at end of file
@@ -29,7 +29,8 @@ try:
 
     # Drop tables
     drop_tables_query = '''
-        DROP TABLE IF EXISTS running_data, music_data
+        DROP TABLE IF EXISTS running_data, music_data, event_counters,
+            running_rollup_hourly, music_rollup_hourly, rollup_backfill
     '''
     print(f"Executing SQL: {drop_tables_query}")
     db_cursor.execute(drop_tables_query)
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import DeclarativeBase, mapped_column
-from sqlalchemy import Integer, String, DateTime, func, BigInteger
+from sqlalchemy import Integer, String, DateTime, func, BigInteger, Index
 
 class Base(DeclarativeBase):
     pass
@@ -7,12 +7,20 @@ class Base(DeclarativeBase):
 class RunningData(Base):
     """ Running Data """
     __tablename__ = "running_data"
+    __table_args__ = (
+        Index('ix_running_data_date_created', 'date_created'),
+        Index('ix_running_data_user_id_date_created', 'user_id', 'date_created'),
+        Index('uq_running_data_trace_id', 'trace_id', unique=True),
+        Index('ix_running_data_event_time', 'event_time'),
+    )
 
     id = mapped_column(Integer, primary_key=True)
     user_id = mapped_column(String(250), nullable=False)
     duration = mapped_column(Integer, nullable=False)
     distance = mapped_column(Integer, nullable=False)
     timestamp = mapped_column(String(100), nullable=False)
+    # timestamp parsed at ingest, in UTC; NULL if it could not be parsed
+    event_time = mapped_column(DateTime, nullable=True)
     trace_id = mapped_column(String(100), nullable=False)
     date_created = mapped_column(DateTime, nullable=False, default=func.now())
 
@@ -23,6 +31,7 @@ class RunningData(Base):
             'duration': self.duration,
             'distance': self.distance,
             'timestamp': self.timestamp,
+            'event_time': self.event_time,
             'trace_id': self.trace_id,
             'date_created': self.date_created
         }
@@ -30,6 +39,12 @@ class RunningData(Base):
 class MusicData(Base):
     """Music Data"""
     __tablename__ = "music_data"
+    __table_args__ = (
+        Index('ix_music_data_date_created', 'date_created'),
+        Index('ix_music_data_user_id_date_created', 'user_id', 'date_created'),
+        Index('uq_music_data_trace_id', 'trace_id', unique=True),
+        Index('ix_music_data_event_time', 'event_time'),
+    )
 
     id = mapped_column(Integer, primary_key=True)
     user_id = mapped_column(String(250), nullable=False)
@@ -37,6 +52,8 @@ class MusicData(Base):
     artist = mapped_column(String(250), nullable=False)
     song_duration = mapped_column(Integer, nullable=False)
     timestamp = mapped_column(String(100), nullable=False)
+    # timestamp parsed at ingest, in UTC; NULL if it could not be parsed
+    event_time = mapped_column(DateTime, nullable=True)
     trace_id = mapped_column(String(100), nullable=False)
     date_created = mapped_column(DateTime, nullable=False, default=func.now())
 
@@ -48,6 +65,51 @@ class MusicData(Base):
             'artist': self.artist,
             'song_duration': self.song_duration,
             'timestamp': self.timestamp,
+            'event_time': self.event_time,
             'trace_id': self.trace_id,
             'date_created': self.date_created
-        }
\ No newline at end of file
+        }
+
+class EventCounter(Base):
+    """ Running total of stored events per type, kept in step with the inserts """
+    __tablename__ = "event_counters"
+
+    event_type = mapped_column(String(50), primary_key=True)
+    num_events = mapped_column(BigInteger, nullable=False, default=0)
+
+class RunningRollupHourly(Base):
+    """ Per-hour count, sum and max of running_data, keyed on the date_created hour """
+    __tablename__ = "running_rollup_hourly"
+
+    hour = mapped_column(DateTime, primary_key=True)
+    count = mapped_column(BigInteger, nullable=False)
+    sum_duration = mapped_column(BigInteger, nullable=False)
+    max_distance = mapped_column(Integer, nullable=False)
+    max_duration = mapped_column(Integer, nullable=False)
+
+    def to_dict(self):
+        return {
+            'hour': self.hour,
+            'count': self.count,
+            'sum_duration': self.sum_duration,
+            'max_distance': self.max_distance,
+            'max_duration': self.max_duration
+        }
+
+class MusicRollupHourly(Base):
+    """ Per-hour count and sum of music_data, keyed on the date_created hour """
+    __tablename__ = "music_rollup_hourly"
+
+    hour = mapped_column(DateTime, primary_key=True)
+    count = mapped_column(BigInteger, nullable=False)
+    sum_song_duration = mapped_column(BigInteger, nullable=False)
+
+    def to_dict(self):
+        return {
+            'hour': self.hour,
+            'count': self.count,
+            'sum_song_duration': self.sum_song_duration
+        }
+
+# Event tables counted in event_counters, by event type
+EVENT_MODELS = {'running_stats': RunningData, 'music_info': MusicData}
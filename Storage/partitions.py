@@ -0,0 +1,157 @@
+"""Monthly RANGE partitioning of the event tables on date_created
+
+Turned on with the partitioning section of app_conf.yml. Each month of
+date_created gets its own partition (p202410 holds October 2024), with a
+pmax partition catching anything past the last month. Range queries on
+date_created only read the partitions they overlap, and retention drops
+whole partitions instead of deleting rows.
+
+MySQL requires every unique key of a partitioned table to contain the
+partitioning column, so partitioned tables have PRIMARY KEY (id,
+date_created) and UNIQUE (trace_id, date_created). That key is weaker
+than UNIQUE (trace_id): a redelivered event stored in a different second
+is not a duplicate to MySQL. Duplicates are then only kept out by the
+trace_id lookup in new_rows() before every insert, and two workers
+storing the same trace_id at the same moment in different seconds can
+both succeed.
+
+The functions take a DB-API connection (mysql.connector at startup,
+pymysql from the Storage scheduler) and return a description of each
+change so the caller can print or log it.
+"""
+from datetime import date, datetime
+
+# event table -> (event_counters type, rollup table, trace_id unique index)
+PARTITIONED_TABLES = {
+    'running_data': ('running_stats', 'running_rollup_hourly', 'uq_running_data_trace_id'),
+    'music_data': ('music_info', 'music_rollup_hourly', 'uq_music_data_trace_id'),
+}
+
+
+def month_start(value):
+    return date(value.year, value.month, 1)
+
+
+def add_months(month, months):
+    year, month_index = divmod(month.year * 12 + month.month - 1 + months, 12)
+    return date(year, month_index + 1, 1)
+
+
+def partition_name(month):
+    return f"p{month:%Y%m}"
+
+
+def partition_definitions(months):
+    """PARTITION clauses for months, followed by the pmax catch-all"""
+    definitions = [f"PARTITION {partition_name(month)} VALUES LESS THAN (TO_DAYS('{add_months(month, 1)}'))"
+                   for month in months]
+    return ", ".join(definitions + ["PARTITION pmax VALUES LESS THAN MAXVALUE"])
+
+
+def months_between(first, last):
+    months = []
+    while first <= last:
+        months.append(first)
+        first = add_months(first, 1)
+    return months
+
+
+def partitioned_months(db_cursor, db_name, table):
+    """Months that have a partition, oldest first. Empty if the table is not partitioned"""
+    db_cursor.execute(
+        "SELECT partition_name FROM information_schema.partitions "
+        "WHERE table_schema = %s AND table_name = %s AND partition_name IS NOT NULL",
+        (db_name, table))
+    return sorted(date(int(name[1:5]), int(name[5:7]), 1)
+                  for (name,) in db_cursor.fetchall() if name != 'pmax')
+
+
+def partition_table(db_cursor, table, months_ahead):
+    """Repartition an existing table by month, from its oldest row to months_ahead from now
+
+    This rebuilds the table, so it is slow on a large one, but only
+    happens once.
+    """
+    _, _, trace_index = PARTITIONED_TABLES[table]
+    db_cursor.execute(f"SELECT MIN(date_created) FROM {table}")
+    oldest = db_cursor.fetchone()[0] or datetime.now()
+    months = months_between(month_start(oldest), add_months(month_start(datetime.now()), months_ahead))
+
+    db_cursor.execute(
+        f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (id, date_created), "
+        f"DROP INDEX {trace_index}, ADD UNIQUE INDEX {trace_index} (trace_id, date_created)")
+    db_cursor.execute(f"ALTER TABLE {table} PARTITION BY RANGE (TO_DAYS(date_created)) "
+                      f"({partition_definitions(months)})")
+    return [f"Partitioned {table} into {len(months)} monthly partitions"]
+
+
+def add_future_partitions(db_cursor, table, months, months_ahead):
+    """Split pmax so there is a partition for each month up to months_ahead from now"""
+    new_months = months_between(add_months(months[-1], 1),
+                                 add_months(month_start(datetime.now()), months_ahead))
+    if not new_months:
+        return []
+    db_cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION pmax INTO "
+                      f"({partition_definitions(new_months)})")
+    return [f"Added partitions {', '.join(partition_name(m) for m in new_months)} to {table}"]
+
+
+def drop_expired_partitions(db_conn, db_cursor, table, months, retention_months):
+    """Drop the partitions that end before the retention cutoff
+
+    The rows leaving with a partition are counted from the hourly rollup,
+    so event_counters stays exact without scanning the partition.
+    DROP PARTITION is DDL and commits on its own, so the counters and the
+    rollup hours of the month are adjusted first, in one transaction of
+    their own, and the partition is dropped after. Deleting the rollup
+    hours makes this re-runnable: after a crash in between, the next run
+    finds nothing left to subtract and only drops the partition.
+    """
+    counter_type, rollup, _ = PARTITIONED_TABLES[table]
+    cutoff = add_months(month_start(datetime.now()), -retention_months)
+
+    changes = []
+    for month in months:
+        end = add_months(month, 1)
+        if end > cutoff:
+            break
+        db_cursor.execute(f"SELECT COALESCE(SUM(count), 0) FROM {rollup} WHERE hour >= %s AND hour < %s FOR UPDATE",
+                          (month, end))
+        removed = int(db_cursor.fetchone()[0])
+        db_cursor.execute("UPDATE event_counters SET num_events = GREATEST(num_events - %s, 0) "
+                          "WHERE event_type = %s", (removed, counter_type))
+        db_cursor.execute(f"DELETE FROM {rollup} WHERE hour >= %s AND hour < %s", (month, end))
+        db_conn.commit()
+
+        db_cursor.execute(f"ALTER TABLE {table} DROP PARTITION {partition_name(month)}")
+        changes.append(f"Dropped partition {partition_name(month)} of {table} ({removed} events)")
+    return changes
+
+
+def maintain_partitions(db_conn, db_name, settings):
+    """Partition the event tables if needed, add upcoming months and apply retention
+
+    Does nothing unless settings['enabled'] is true. A retention_months
+    of 0 keeps every partition.
+    """
+    if not settings.get('enabled'):
+        return []
+
+    changes = []
+    db_cursor = db_conn.cursor()
+    try:
+        for table in PARTITIONED_TABLES:
+            months = partitioned_months(db_cursor, db_name, table)
+            if not months:
+                changes += partition_table(db_cursor, table, settings['months_ahead'])
+                months = partitioned_months(db_cursor, db_name, table)
+            else:
+                changes += add_future_partitions(db_cursor, table, months, settings['months_ahead'])
+
+            if settings.get('retention_months'):
+                changes += drop_expired_partitions(db_conn, db_cursor, table, months,
+                                                   settings['retention_months'])
+        db_conn.commit()
+    finally:
+        db_cursor.close()
+    return changes
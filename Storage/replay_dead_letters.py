@@ -0,0 +1,92 @@
+# replay_dead_letters.py
+"""Publish dead-lettered messages back to the service that rejected them
+
+Run once the bug that sent them to the dead-letter topic is fixed:
+
+    python replay_dead_letters.py                      # everything not replayed yet
+    python replay_dead_letters.py --source storage     # only what Storage rejected
+    python replay_dead_letters.py --dry-run            # list without publishing
+
+The original bytes are published, with their original partition key, to
+the replay topic of the service that dead-lettered them
+(events.replay_topics), not to the events topic: the other consumers of
+events (Processing, the other of Storage / Anomaly Detector) already
+processed the message and would count it twice. Storage still drops
+events it already stored by trace_id; the Anomaly Detector does not
+deduplicate, so a message replayed twice can be reported twice.
+
+Progress is committed in the dead_letter_replay consumer group, so a
+second run only picks up newer dead letters. With --source, a
+partition's offset is only committed past the last dead letter before
+the first one skipped, so the skipped ones can still be replayed later;
+the replayed ones after it are then replayed again by the next run.
+"""
+import argparse
+import os
+import yaml
+from pykafka import KafkaClient
+from pykafka.common import OffsetType
+from dead_letter import parse_dead_letter
+
+
+def replay_dead_letters(source=None, dry_run=False):
+    if "TARGET_ENV" in os.environ and os.environ["TARGET_ENV"] == "test":
+        app_conf_file = "/config/app_conf.yml"
+    else:
+        app_conf_file = "app_conf.yml"
+
+    with open(app_conf_file, 'r') as f:
+        app_config = yaml.safe_load(f.read())
+
+    hostname = "%s:%d" % (app_config['events']['hostname'], app_config['events']['port'])
+    client = KafkaClient(hosts=hostname)
+    dead_letter_topic = client.topics[str.encode(app_config['events']['dead_letter_topic'])]
+    replay_topics = app_config['events']['replay_topics']
+
+    # Stops once it has caught up with the dead-letter topic
+    consumer = dead_letter_topic.get_simple_consumer(consumer_group=b'dead_letter_replay',
+                                                     auto_commit_enable=False,
+                                                     auto_offset_reset=OffsetType.EARLIEST,
+                                                     consumer_timeout_ms=5000)
+    producers = {}
+    # partition id -> offset to resume from: the one after the last dead letter
+    # up to which nothing was skipped (pykafka commits the next offset to read)
+    committable = {}
+    blocked = set()
+    replayed = skipped = 0
+    try:
+        for message in consumer:
+            record = parse_dead_letter(message.value)
+            if (source and record['source'] != source) or record['source'] not in replay_topics:
+                skipped += 1
+                blocked.add(message.partition_id)
+                continue
+
+            print(f"{record['source']} partition {record['partition']} offset {record['offset']} "
+                  f"failed at {record['failed_at']}: {record['error']}")
+            if not dry_run:
+                if record['source'] not in producers:
+                    topic = client.topics[str.encode(replay_topics[record['source']])]
+                    producers[record['source']] = topic.get_sync_producer()
+                producers[record['source']].produce(record['value'], partition_key=record['partition_key'])
+            replayed += 1
+            if message.partition_id not in blocked:
+                committable[message.partition_id] = message.offset + 1
+
+        if not dry_run and committable:
+            consumer.commit_offsets(partition_offsets=[(dead_letter_topic.partitions[partition_id], offset)
+                                                       for partition_id, offset in committable.items()])
+    finally:
+        for producer in producers.values():
+            producer.stop()
+        consumer.stop()
+    print(f"{'Found' if dry_run else 'Replayed'} {replayed} dead letters, skipped {skipped} from other sources")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish dead-lettered messages back to the service that rejected them")
+    parser.add_argument("--source", choices=["storage", "anomaly_detector"],
+                        help="only replay messages dead-lettered by this service")
+    parser.add_argument("--dry-run", action="store_true", help="list the dead letters without publishing them")
+    args = parser.parse_args()
+    replay_dead_letters(source=args.source, dry_run=args.dry_run)
@@ -0,0 +1,81 @@
+"""Replaying the dead-letter topic twice must not publish anything the second time"""
+import os
+import sys
+from types import SimpleNamespace
+
+STORAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, STORAGE_DIR)
+
+import replay_dead_letters  # noqa: E402
+from dead_letter import dead_letter  # noqa: E402
+
+
+class FakeConsumer:
+    """Reads a partition from its committed offset, which like pykafka's is the next offset to read"""
+
+    def __init__(self, topic):
+        self.topic = topic
+        self.messages = [message for partition_id, messages in topic.messages.items()
+                         for message in messages[topic.committed.get(partition_id, 0):]]
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def commit_offsets(self, partition_offsets):
+        for partition, offset in partition_offsets:
+            self.topic.committed[partition.id] = offset
+
+    def stop(self):
+        pass
+
+
+class FakeProducer:
+    def __init__(self, published):
+        self.published = published
+
+    def produce(self, value, partition_key=None):
+        self.published.append(value)
+
+    def stop(self):
+        pass
+
+
+class FakeTopic:
+    def __init__(self, published):
+        self.published = published
+        self.messages = {}
+        self.committed = {}
+        self.partitions = {}
+
+    def append(self, partition_id, value):
+        self.partitions.setdefault(partition_id, SimpleNamespace(id=partition_id))
+        messages = self.messages.setdefault(partition_id, [])
+        messages.append(SimpleNamespace(partition_id=partition_id, offset=len(messages), value=value))
+
+    def get_simple_consumer(self, **kwargs):
+        return FakeConsumer(self)
+
+    def get_sync_producer(self):
+        return FakeProducer(self.published)
+
+
+def test_second_replay_publishes_nothing(monkeypatch):
+    published = []
+    topics = {b'events_dlq': FakeTopic(published),
+              b'events_replay_storage': FakeTopic(published),
+              b'events_replay_anomaly_detector': FakeTopic(published)}
+    for partition_id in (0, 1):
+        for offset in range(3):
+            failed = SimpleNamespace(partition_key=b'user', partition_id=partition_id, offset=offset,
+                                     value=f"event {partition_id}-{offset}".encode())
+            topics[b'events_dlq'].append(partition_id, dead_letter(failed, "boom", "storage"))
+
+    monkeypatch.chdir(STORAGE_DIR)
+    monkeypatch.setattr(replay_dead_letters, "KafkaClient", lambda hosts: SimpleNamespace(topics=topics))
+
+    replay_dead_letters.replay_dead_letters()
+    assert sorted(published) == sorted(f"event {p}-{o}".encode() for p in (0, 1) for o in range(3))
+
+    published.clear()
+    replay_dead_letters.replay_dead_letters()
+    assert published == []
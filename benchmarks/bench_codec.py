@@ -0,0 +1,62 @@
+"""Micro-benchmark of the event codec: encode/decode cost and bytes per event
+
+Usage: python benchmarks/bench_codec.py [--number 100000]
+"""
+import argparse
+import os
+import sys
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Receiver"))
+
+from event_codec import decode_event, encode_event  # noqa: E402
+
+RUNNING_EVENT = {
+    "type": "running_stats",
+    "datetime": "2024-09-10T09:12:33",
+    "payload": {
+        "user_id": str(uuid.uuid4()),
+        "duration": 3600,
+        "distance": 5000,
+        "timestamp": "2024-09-10T09:12:33.001Z",
+        "trace_id": str(uuid.uuid4()),
+    },
+}
+
+MUSIC_EVENT = {
+    "type": "music_info",
+    "datetime": "2024-09-10T09:12:33",
+    "payload": {
+        "user_id": str(uuid.uuid4()),
+        "song_name": "Run Boy Run",
+        "artist": "Woodkid",
+        "song_duration": 180,
+        "timestamp": "2024-09-10T09:12:33.001Z",
+        "trace_id": str(uuid.uuid4()),
+    },
+}
+
+
+def bench(name, event, codec, number):
+    data = encode_event(event, codec)
+    assert decode_event(data) == event
+
+    encode_sec = timeit.timeit(lambda: encode_event(event, codec), number=number)
+    decode_sec = timeit.timeit(lambda: decode_event(data), number=number)
+    print(f"{name:<14}{codec:<8}{len(data):>8}{encode_sec / number * 1e6:>12.2f}{decode_sec / number * 1e6:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=100000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    print(f"{'event':<14}{'codec':<8}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, event in [("running_stats", RUNNING_EVENT), ("music_info", MUSIC_EVENT)]:
+        for codec in ["json", "binary"]:
+            bench(name, event, codec, args.number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""Benchmark of schema validation cost per request
+
+Compares what connexion does by default (build a jsonschema validator for
+every request/response, then validate) with the precompiled validators from
+validation.py, for the Receiver's RunningStats and MusicInfo bodies and the
+Storage list responses.
+
+Usage: python benchmarks/bench_validation.py [--number 2000]
+"""
+import argparse
+import os
+import sys
+import timeit
+import uuid
+
+import yaml
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "Receiver"))
+
+from connexion.json_schema import Draft4RequestValidator, Draft4ResponseValidator  # noqa: E402
+
+from validation import compiled_validator  # noqa: E402
+
+
+def load_schemas(service):
+    with open(os.path.join(ROOT, service, "openapi.yaml")) as f:
+        return yaml.safe_load(f)["components"]["schemas"]
+
+
+def running_record(with_trace):
+    record = {
+        "user_id": str(uuid.uuid4()),
+        "duration": 3600,
+        "distance": 5000,
+        "timestamp": "2024-09-10T09:12:33.001Z",
+    }
+    if with_trace:
+        record["trace_id"] = str(uuid.uuid4())
+    return record
+
+
+def music_record(with_trace):
+    record = {
+        "user_id": str(uuid.uuid4()),
+        "song_name": "Run Boy Run",
+        "artist": "Woodkid",
+        "song_duration": 180,
+        "timestamp": "2024-09-10T09:12:33.001Z",
+    }
+    if with_trace:
+        record["trace_id"] = str(uuid.uuid4())
+    return record
+
+
+def bench(name, validator_cls, schema, instance, number):
+    def per_call():
+        validator_cls(schema, format_checker=validator_cls.FORMAT_CHECKER).validate(instance)
+
+    def precompiled():
+        compiled_validator(validator_cls, schema).validate(instance)
+
+    per_call_sec = timeit.timeit(per_call, number=number)
+    precompiled_sec = timeit.timeit(precompiled, number=number)
+    print(f"{name:<30}{per_call_sec / number * 1e6:>14.1f}{precompiled_sec / number * 1e6:>14.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=2000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    receiver = load_schemas("Receiver")
+    storage = load_schemas("Storage")
+
+    print(f"{'validation':<30}{'per-call us':>14}{'compiled us':>14}")
+    bench("RunningStats request", Draft4RequestValidator,
+          receiver["RunningStats"], running_record(False), args.number)
+    bench("MusicInfo request", Draft4RequestValidator,
+          receiver["MusicInfo"], music_record(False), args.number)
+
+    for size in [10, 100, 1000]:
+        number = max(args.number // size, 5)
+        bench(f"Storage running list ({size})", Draft4ResponseValidator,
+              {"type": "array", "items": storage["RunningStats"]},
+              [running_record(True) for _ in range(size)], number)
+        bench(f"Storage music list ({size})", Draft4ResponseValidator,
+              {"type": "array", "items": storage["MusicInfo"]},
+              [music_record(True) for _ in range(size)], number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""Benchmark of Storage window-query latency with and without the secondary indexes
+
+Fills running_data with --rows rows spread over --days days, then times the
+queries Storage runs for Processing: a 30 second date_created window and a
+one-day window for a single user. Each table size is measured with the
+indexes from models.py and again after dropping them.
+
+Usage:
+    python benchmarks/bench_window_query.py --rows 1000000 10000000
+    python benchmarks/bench_window_query.py --url mysql+pymysql://root:pw@localhost:3306/bench
+
+Point --url at a scratch database: the running_data table there is dropped.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, create_engine, insert, text
+from sqlalchemy.orm import sessionmaker
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Storage"))
+
+from models import RunningData  # noqa: E402
+
+INSERT_CHUNK = 50000
+
+
+def populate(engine, rows, days, users):
+    RunningData.__table__.drop(engine, checkfirst=True)
+    RunningData.__table__.create(engine)
+
+    start = datetime(2024, 1, 1)
+    step = timedelta(days=days) / rows
+    user_ids = [str(uuid.uuid4()) for _ in range(users)]
+
+    with engine.begin() as conn:
+        for offset in range(0, rows, INSERT_CHUNK):
+            conn.execute(insert(RunningData), [
+                {
+                    "user_id": random.choice(user_ids),
+                    "duration": random.randint(300, 7200),
+                    "distance": random.randint(500, 42000),
+                    "timestamp": "2024-01-01T00:00:00.000Z",
+                    "trace_id": str(uuid.uuid4()),
+                    "date_created": start + step * i,
+                }
+                for i in range(offset, min(offset + INSERT_CHUNK, rows))
+            ])
+    return start + timedelta(days=days), user_ids
+
+
+def time_query(session_factory, query, repeat):
+    timings = []
+    for _ in range(repeat):
+        session = session_factory()
+        began = time.perf_counter()
+        rows = query(session).all()
+        timings.append((time.perf_counter() - began) * 1000)
+        session.close()
+    return statistics.median(timings), len(rows)
+
+
+def measure(session_factory, end, user_id, repeat, label):
+    window_start = end - timedelta(seconds=30)
+    day_start = end - timedelta(days=1)
+
+    queries = {
+        "30s window": lambda s: s.query(RunningData).filter(
+            and_(RunningData.date_created >= window_start, RunningData.date_created < end)),
+        "user 1d window": lambda s: s.query(RunningData).filter(
+            and_(RunningData.user_id == user_id,
+                 RunningData.date_created >= day_start, RunningData.date_created < end)),
+    }
+    for name, query in queries.items():
+        ms, count = time_query(session_factory, query, repeat)
+        print(f"{label:<28}{name:<18}{count:>8}{ms:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="sqlite:////tmp/bench_window_query.sqlite",
+                        help="SQLAlchemy URL of a scratch database")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000000, 10000000])
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine(args.url)
+    session_factory = sessionmaker(bind=engine)
+
+    print(f"{'table':<28}{'query':<18}{'rows':>8}{'median ms':>12}")
+    for rows in args.rows:
+        end, user_ids = populate(engine, rows, args.days, args.users)
+        measure(session_factory, end, user_ids[0], args.repeat, f"{rows} rows, indexed")
+
+        with engine.begin() as conn:
+            for index in RunningData.__table__.indexes:
+                index.drop(conn)
+        measure(session_factory, end, user_ids[0], args.repeat, f"{rows} rows, no indexes")
+
+    RunningData.__table__.drop(engine, checkfirst=True)
+
+
+if __name__ == "__main__":
+    main()
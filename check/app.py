@@ -3,6 +3,7 @@ from connexion import NoContent
 import json
 import os
 import yaml
+import validation
 import logging
 import logging.config
 import requests
@@ -139,7 +140,7 @@ def init_scheduler():
     sched.start()
 
 app = connexion.FlaskApp(__name__, specification_dir='')
-app.add_api("openapi.yml", base_path="/check", strict_validation=True, validate_responses=True)
+app.add_api("openapi.yml", base_path="/check", **validation.api_options(app_config))
 CORS(app.app)
 
 